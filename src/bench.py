@@ -0,0 +1,242 @@
+'''
+Benchmarks every stage of generation at several sizes, star counts and worker counts.
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import numpy as np
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import instrument as inst
+import process as proc
+import utility as util
+
+# fixed seeds, so every run measures the same work
+noise_seed = 1
+stage_seed = 2
+cutoff = 0.7
+universe = 13.8
+
+# stages that can be benchmarked, and what their throughput is measured in
+stages = {"prob_worker": "voxels", "prob_worker_array": "voxels", "probability_map": "voxels",
+          "find_clusters": "voxels", "generate_stars": "stars", "age_stars": "stars",
+          "write_dist_img": "voxels", "write_cluster_image": "voxels",
+          "write_star_images": "stars", "write_HR_diagram": "stars"}
+
+# parse a size written as XxYxZ
+def parse_size(s):
+    return tuple(int(n) for n in s.split("x"))
+
+# the probability map of a size, read from the map cache in cache_dir, generating it
+# if needed
+def bench_map(size, cache_dir):
+    params = util.prob_cache_params(noise_seed, size, proc.feature_size, proc.chunk_size)
+    path = os.path.join(cache_dir, "prob_{:s}.cache".format(util.cache_key(params)))
+    p = util.read_prob_cache(path, params)
+    if p is None:
+        util.write_prob_cache(path, params, proc.probability_map(noise_seed, size))
+        p = util.read_prob_cache(path, params)
+    return p
+
+# generate the probability map of a size ahead of the cases that read it
+def prepare(size, cache_dir):
+    inst.sink = None
+    bench_map(size, cache_dir)
+
+# Set up the inputs of a case, and return the function to time along with the amount
+# of work it does. Only the function is timed, but the inputs count towards peak RSS.
+def setup(case, cache_dir, out_dir):
+    stage, size, count = case["stage"], case["img_size"], case["count"]
+    if stage in ("prob_worker", "prob_worker_array"):
+        worker = getattr(proc, stage)
+        return lambda: worker((0, 0, 0, noise_seed)), int(np.prod(proc.chunk_size))
+    voxels = int(np.prod(size))
+    if stage == "probability_map":
+        return lambda: proc.probability_map(noise_seed, size), voxels
+    prob = np.power(bench_map(size, cache_dir), 2)
+    if stage == "write_dist_img":
+        return lambda: util.write_dist_img(prob, size, os.path.join(out_dir, "distribution")), voxels
+    if stage == "find_clusters":
+        return lambda: proc.find_clusters(prob, cutoff, universe, size, seed=stage_seed), voxels
+    clusters, ages = proc.find_clusters(prob, cutoff, universe, size, seed=stage_seed)
+    if stage == "write_cluster_image":
+        return lambda: util.write_cluster_image(clusters, size, os.path.join(out_dir, "clusters"), seed=stage_seed), voxels
+    if stage == "generate_stars":
+        return lambda: proc.generate_stars(prob, clusters, count, size, stage_seed), count
+    stars = proc.generate_stars(prob, clusters, count, size, stage_seed)
+    if stage == "age_stars":
+        return lambda: proc.age_stars(stars, ages, universe, stage_seed), count
+    stars = proc.age_stars(stars, ages, universe, stage_seed)
+    if stage == "write_star_images":
+        return lambda: util.write_star_images(stars, size, [(os.path.join(out_dir, "stars_eye"), 5),
+                                                            (os.path.join(out_dir, "stars_hubble"), 1000)]), count
+    if stage == "write_HR_diagram":
+        return lambda: util.write_HR_diagram(stars, os.path.join(out_dir, "HR")), count
+    raise ValueError("unknown stage: {:s}".format(stage))
+
+# a memory field of /proc/self/status, such as VmRSS, in bytes, or None where there is
+# no /proc
+def proc_memory(field):
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# current resident set size of this process, in bytes
+def current_rss():
+    rss = proc_memory("VmRSS")
+    return rss if rss is not None else peak_rss()
+
+# Reset the peak resident set size of this process to its current size, so the peak
+# only covers what runs afterwards. Only possible on Linux; returns whether it worked.
+def reset_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        return True
+    except OSError:
+        return False
+
+# peak resident set size of this process and the children it has waited for, in bytes
+def peak_rss():
+    self_rss = proc_memory("VmHWM")
+    if self_rss is None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return max(self_rss, child_rss)
+
+# Run a single case, repeat times, keeping the fastest. Runs in its own process, so the
+# peak RSS belongs to this case alone. The inputs are built before the peak is reset,
+# so stage_rss, the growth of the peak over the memory held after setup, is the
+# stage's own. Where the peak cannot be reset it also includes any setup peak.
+# Instrumentation is off, so it is not measured.
+def run_case(case, repeat, cache_dir):
+    proc.workers = case["workers"]
+    inst.sink = None
+    with tempfile.TemporaryDirectory() as out_dir:
+        func, work = setup(case, cache_dir, out_dir)
+        setup_rss = current_rss()
+        reset_peak()
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t)
+    wall = min(times)
+    peak = peak_rss()
+    return dict(case, wall=wall, peak_rss=peak, setup_rss=setup_rss, stage_rss=max(peak - setup_rss, 0), work=work,
+                throughput=work / wall if wall > 0 else None, unit=stages[case["stage"]])
+
+# every case of the requested stages. Worker counts only apply to probability_map,
+# star counts only to the star stages, and sizes to everything but the single chunk.
+def cases(names, sizes, counts, workers):
+    out = []
+    for stage in names:
+        if stage in ("prob_worker", "prob_worker_array"):
+            out.append({"stage": stage, "img_size": list(proc.chunk_size), "count": None, "workers": 1})
+            continue
+        for size in sizes:
+            if stage == "probability_map":
+                out += [{"stage": stage, "img_size": list(size), "count": None, "workers": w} for w in workers]
+            elif stages[stage] == "stars":
+                out += [{"stage": stage, "img_size": list(size), "count": c, "workers": None} for c in counts]
+            else:
+                out.append({"stage": stage, "img_size": list(size), "count": None, "workers": None})
+    return out
+
+# Run every case, each in a fresh process. A case that fails is recorded with its
+# error rather than stopping the run.
+def run(todo, repeat, cache_dir):
+    results = []
+    for i, case in enumerate(todo):
+        print("[{:d}/{:d}] {:s} {:s} count={} workers={}... ".format(i+1, len(todo), case["stage"],
+              "x".join(str(n) for n in case["img_size"]), case["count"], case["workers"]), end="", flush=True)
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                r = pool.submit(run_case, case, repeat, cache_dir).result()
+                print("{:.3f}s, {:.1f} MB over {:.1f} MB of inputs, {:.3g} {:s}/s".format(
+                      r["wall"], r["stage_rss"] / 2**20, r["setup_rss"] / 2**20,
+                      r["throughput"] or 0, r["unit"]))
+            except Exception as e:
+                r = dict(case, error="{:s}: {}".format(type(e).__name__, e))
+                print("failed ({:s})".format(r["error"]))
+        results.append(r)
+    return results
+
+# description of the machine and libraries the results were measured with
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+# identifies the same case in two result files
+def case_key(r):
+    return (r["stage"], tuple(r["img_size"]), r["count"], r["workers"])
+
+# Compare results against a baseline. Prints the ratio of wall times for every case in
+# both, and returns the cases that are slower by more than tolerance.
+def compare(results, baseline, tolerance):
+    base = {case_key(r): r for r in baseline["results"] if "error" not in r}
+    slower = []
+    print("Compared to baseline from {:s}:".format(baseline["environment"]["time"]))
+    for r in results:
+        b = base.get(case_key(r))
+        if b is None or "error" in r:
+            continue
+        ratio = r["wall"] / b["wall"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            slower.append(r)
+            flag = "  SLOWER"
+        print("  {:s} {:s} count={} workers={}: {:.3f}s -> {:.3f}s ({:.2f}x){:s}".format(
+            r["stage"], "x".join(str(n) for n in r["img_size"]), r["count"], r["workers"],
+            b["wall"], r["wall"], ratio, flag))
+    return slower
+
+parser = argparse.ArgumentParser(description="Benchmarks the stages of starscape generation.")
+parser.add_argument("--stages", nargs="+", default=list(stages), choices=list(stages), help="stages to run (default: all)")
+parser.add_argument("--sizes", nargs="+", type=parse_size, default=[(32, 256, 256), (32, 512, 512), (64, 512, 512)],
+                    help="volume sizes, as XxYxZ (default: 32x256x256 32x512x512 64x512x512)")
+parser.add_argument("--counts", nargs="+", type=int, default=[10000, 100000], help="star counts (default: 10000 100000)")
+parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4], help="worker counts for probability_map (default: 1 2 4)")
+parser.add_argument("--repeat", type=int, default=3, help="times to run each case, keeping the fastest (default: 3)")
+parser.add_argument("--output", default=os.path.join(os.path.curdir, 'output', 'bench.json'), help="results file (default: ./output/bench.json)")
+parser.add_argument("--baseline", help="results file to compare against")
+parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown allowed before a case counts as slower (default: 0.1)")
+
+def main(argv):
+    args = parser.parse_args(argv)
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(args.output)), "bench_maps")
+    os.makedirs(cache_dir, exist_ok=True)
+    todo = cases(args.stages, args.sizes, args.counts, args.workers)
+    # maps are generated in their own process, so they do not count towards any case
+    print("Preparing probability maps... ", end="", flush=True)
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        for size in dict.fromkeys(tuple(c["img_size"]) for c in todo if c["stage"] not in
+                                  ("prob_worker", "prob_worker_array", "probability_map")):
+            pool.submit(prepare, size, cache_dir).result()
+    print("Done")
+    results = run(todo, args.repeat, cache_dir)
+    with open(args.output, "w") as fh:
+        json.dump({"environment": environment(), "repeat": args.repeat, "results": results}, fh, indent=1)
+    print("Results written to", args.output)
+    if args.baseline is not None:
+        with open(args.baseline) as fh:
+            slower = compare(results, json.load(fh), args.tolerance)
+        if slower:
+            print("{:d} case(s) slower than the baseline".format(len(slower)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,125 +4,204 @@ Formulae
 import numpy as np
 
 
+# spectral classes, and the typical mass of each one
+spectral_classes = "OBAFGKM"
+class_masses = np.array([60, 18, 3.2, 1.7, 1.1, 0.65, 0.3])
+
 # Randomly generate mass for a given class type.
 # Value will be in range cm +/- 0.5(cm) for each class.
-def new_mass(c):
-    cm = {"O":60, "B":18, "A":3.2, "F":1.7, "G":1.1, "K":0.65, "M":0.3}
-    return cm[c]+np.random.uniform(-0.5*cm[c], 0.5*cm[c])
+# If size is given, returns an array of that many masses. c may also be an array of
+# class letters or class numbers (indices into spectral_classes), giving one mass each.
+# Random values in this module are drawn from rng, a numpy Generator, or from a fresh
+# generator if it is not given.
+def new_mass(c, size=None, rng=None):
+    rng = np.random.default_rng(rng)
+    if isinstance(c, str):
+        cm = class_masses[spectral_classes.index(c)]
+        return cm+rng.uniform(-0.5*cm, 0.5*cm, size)
+    c = np.asarray(c)
+    if c.dtype.kind in "US":
+        letters, c = np.unique(c, return_inverse=True)
+        c = np.array([spectral_classes.index(l) for l in letters], dtype=int)[c]
+    cm = class_masses[c]
+    return cm+rng.uniform(-0.5*cm, 0.5*cm)
 
 # generate a random age, in the range 0-13*10^10. Allow passing in a value that
-# limits the return value, ensuring that nothing is older than the universe
-def new_age(start, universe):
+# limits the return value, ensuring that nothing is older than the universe.
+# If size is given, returns an array of that many ages.
+def new_age(start, universe, size=None, rng=None):
+    rng = np.random.default_rng(rng)
     universe = (universe * 10**9)
+    if size is not None:
+        if universe - start <= 0:
+            return np.zeros(size, dtype=np.int64)
+        return (rng.beta(3.33, 6.66, size) * (universe - start)).astype(np.int64)
     if universe - start <= 0:
         return 0
-    return int(np.random.beta(3.33,6.66) * (universe - start))
+    return int(rng.beta(3.33,6.66) * (universe - start))
 
-# Kroupa's 2001 model of the Intitial Mass Function.
+# Kroupa's 2001 model of the Intitial Mass Function. Works on scalars and arrays.
 def imf(mass):
-    if mass < 0.08:
-        return mass**(-1*0.3)
-    elif mass < 0.5:
-        return mass**(-1*1.3)
-    else:
-        return mass**(-1*2.3)
+    mass = np.asarray(mass, dtype=float)
+    return np.select([mass < 0.08, mass < 0.5],
+                     [mass**(-1*0.3), mass**(-1*1.3)],
+                     mass**(-1*2.3))[()]
 
 # calculate luminosity from mass, relative to the luminosity of the sun. page 139,
 # https://books.google.com/books?id=r1dNzr8viRYC&pg=PA138
-def lum(mass):
-    val = 0
-    if mass < 0.43:
-        val = 0.23 * mass**2.3
-    elif mass < 2:
-        val = mass**4
-    elif mass < 55:
-        val = 1.4 * mass**3.5
-    else:
-        val = 32000 * mass
-    return val + np.random.uniform(-0.1*val, 0.1*val) + 2 * np.random.uniform(-0.05*val, 0.05*val)
+# Works on scalars and arrays.
+def lum(mass, rng=None):
+    rng = np.random.default_rng(rng)
+    mass = np.asarray(mass, dtype=float)
+    val = np.select([mass < 0.43, mass < 2, mass < 55],
+                    [0.23 * mass**2.3, mass**4, 1.4 * mass**3.5],
+                    32000 * mass)
+    return (val + rng.uniform(-0.1*val, 0.1*val) + 2 * rng.uniform(-0.05*val, 0.05*val))[()]
 
 # approximate temperature from mass, based on the spectral standard stars for each
 # spectral type. https://en.wikipedia.org/wiki/Stellar_classification#Spectral_types
-def temp(mass):
+# Works on scalars and arrays.
+def temp(mass, rng=None):
+    rng = np.random.default_rng(rng)
     val = 6.21 * np.power(mass, 0.533)
-    return val + np.random.uniform(-0.1*val, 0.1*val) + 2 * np.random.uniform(-0.05*val, 0.05*val)
+    return val + rng.uniform(-0.1*val, 0.1*val) + 2 * rng.uniform(-0.05*val, 0.05*val)
+
+# RGB values for temperatures between 1500K-15000K, sampled from data at
+# https://academo.org/demos/colour-temperature-relationship/ and manually tweaked by
+# adding duplicate colors.
+colors = [(255, 140, 50), (255,143,55), (255,158,79),
+(255, 177, 110), (255, 206, 166), (255,215,182),
+(255, 228, 206), (255, 255, 245),
+(255, 255, 255), (255, 255, 255),(255, 255, 255),
+(255, 255, 255), (243, 242, 255),(221, 231, 255),
+(210, 223, 255), (196, 214, 255), (191, 211, 255),
+(202, 218, 255), (185, 207, 255), (179, 202, 255),
+(171, 195, 255), (151, 175, 255)]
+palette = np.array(colors, dtype=np.uint8)
 
-# calculate color from temperature. Sampled from data at
-# https://academo.org/demos/colour-temperature-relationship/
+# index of the closest valid color for a temperature. Since even the coolest stars
+# are hotter than 1500K, we artificially increase this range by decreasing the
+# star's temperature by a constant offset. Works on scalars and arrays.
+def color_index(temp, offset=1):
+    return np.clip(np.asarray(temp)-offset, 0, len(colors)-1).astype(int)
+
+# calculate color from temperature. For an array of temperatures, returns an array of
+# RGB rows.
 def color(temp, offset=1):
-    # RGB values for temperatures between 1500K-15000K, manually tweaked by adding
-    # duplicate colors. Since even the coolest stars are hotter than 1500K,
-    # we artificially increase this range by decreasing
-    # the star's temperature by a constant offset.
-    colors = [(255, 140, 50), (255,143,55), (255,158,79),
-    (255, 177, 110), (255, 206, 166), (255,215,182),
-    (255, 228, 206), (255, 255, 245),
-    (255, 255, 255), (255, 255, 255),(255, 255, 255),
-    (255, 255, 255), (243, 242, 255),(221, 231, 255),
-    (210, 223, 255), (196, 214, 255), (191, 211, 255),
-    (202, 218, 255), (185, 207, 255), (179, 202, 255),
-    (171, 195, 255), (151, 175, 255)]
     # select closest valid color from the list
-    return colors[np.clip(temp-offset, 0, len(colors)-1).astype(int)]
+    i = color_index(temp, offset)
+    if np.ndim(i) == 0:
+        return colors[i]
+    return palette[i]
 
 # inverse square law of brightness.
 def inv_sq(lum, dist, off):
     return lum / (4.0 * np.pi * np.square(dist+off))
 
-# determine the stage of life a star is in, based on its mass and age
-# data approximated from slides 16 and 17 of https://www.astro.caltech.edu/~george/ay20/Ay20-Lec9x.pdf
-def stage(mass, age):
-    T = []
-    L = []
-    y = []
-    if mass < 0.875:
-        return 0,0
-    elif 0.875 <= mass and mass < 1.125:
-        T = [np.log10(temp(mass)), 0.76, 0.79, 0.785, 0.74, 0.695, 0.55]
-        L = [np.log10(lum(mass)), 0, 0.2, 0.3, 0.48, 0.45, 2.6]
-        Y = [0, mass**-2.5*10**10, 7*10**9, 2*10**9, 1.2*10**9, 1.57*10**8, 2*10**9]
-    elif 1.125 <= mass and mass < 1.375:
-        T = [np.log10(temp(mass)), 0.83, 0.815, 0.85, 0.79, 0.69, 0.55]
-        L = [np.log10(lum(mass)), 0.35, 0.55, 0.6, 0.8, 0.75, 2.65]
-        Y = [0, mass**-2.5*10**10, 2.803*10**9, 1.824*10**9, 1.045*10**9, 1.463*10**8, 5*10**8]
-    elif 1.375 <= mass and mass < 1.875:
-        T = [np.log10(temp(mass)), 0.92, 0.86, 0.905, 0.85, 0.69, 0.55]
-        L = [np.log10(lum(mass)), 0.7, 0.85, 0.95, 1.15, 0.95, 2.7]
-        Y = [0, mass**-2.5*10**10, 1.553*10**9, 8.1*10**7, 3.49*10**8, 1.049*10**8, 3*10**8]
-    elif 1.875 <= mass and mass < 2.625:
-        T = [np.log10(temp(mass)), 1.05, 0.95, 1.025, 0.98, 0.69, 0.7]
-        L = [np.log10(lum(mass)), 1.5, 1.7, 1.75, 1.8, 1.5, 2.8]
-        Y = [0, mass**-2.5*10**10, 4.802*10**8, 1.647*10**7, 3.696*10**7, 1.31*10**7, 3.829*10**7]
-    elif 2.625 <= mass and mass < 4:
-        T = [np.log10(temp(mass)), 1.45, 1.06, 1.1, 1.05, 0.69, 0.61, 0.67, 0.75, 0.64]
-        L = [np.log10(lum(mass)), 1.99, 2.15, 2.2, 2.4, 1.99, 2.45, 2.15, 2.4, 2.4]
-        Y = [0, mass**-2.5*10**10, 2.212*10**8, 1.042*10**7, 1.033*10**7, 4.505*10**6, 4.238*10**6, 2.51*10**7, 4.08*10**7, 6*10**6]
-    elif 4 <= mass and mass < 7:
-        T = [np.log10(temp(mass)), 1.285, 1.2, 1.24, 1.18, 0.66, 0.61, 0.65, 0.75, 0.91, 0.69]
-        L = [np.log10(lum(mass)), 2.8, 3, 3.1, 3.17, 2.9, 3.15, 3.05, 3.17, 3.4, 3.38]
-        Y = [0, mass**-2.5*10**10, 6.547*10**7, 2.173*10**6, 1.372*10**6, 7.532*10**5, 4.857*10**5, 6.05*10**6, 1.02*10**6, 9*10**6, 9.3*10**5]
-    elif 7 <= mass and mass < 12:
-        T = [np.log10(temp(mass)), 1.42, 1.335, 1.38, 1.28, 0.645, 0.6, 0.61, 1.05, 1.13, 0.97]
-        L = [np.log10(lum(mass)), 3.6, 3.9, 3.95, 4, 3.8, 4.02, 3.97, 3.97, 4.25, 4.3]
-        Y = [0, mass**-2.5*10**10, 2.144*10**7, 6.053*10**5, 9.133*10**4, 1.477*10**5, 6.552*10**4, 4.9*10**5, 9.5*10**4, 3.28*10**6, 1.55*10**5]
-    elif 12 <= mass and mass < 25:
-        T = [np.log10(temp(mass)), 1.515, 1.42, 1.48, 1.26, 1.2, 1.11, 0.98, 0.61]
-        L = [np.log10(lum(mass)), 4.35, 4.6, 4.65, 4.75, 4.8, 4.9, 4.92, 4.9]
-        Y = [0, mass**-2.5*10**10, 1.01*10**7, 2.270*10**5, 7.55*10**4, 7.17*10**5, 6.2*10**5, 1.9*10**5, 3.5*10**4]
+# Evolutionary tracks, approximated from slides 16 and 17 of
+# https://www.astro.caltech.edu/~george/ay20/Ay20-Lec9x.pdf
+# stage_bins holds the lower mass limit of each track; stars above the last limit
+# become neutron stars. Each track lists the log temperature, log luminosity and
+# duration (years) of each stage after the main sequence. The main sequence itself
+# depends on the star's mass and is filled in by stages().
+stage_bins = np.array([0.875, 1.125, 1.375, 1.875, 2.625, 4, 7, 12, 25])
+stage_tracks = [
+    ([0.76, 0.79, 0.785, 0.74, 0.695, 0.55],
+     [0, 0.2, 0.3, 0.48, 0.45, 2.6],
+     [7*10**9, 2*10**9, 1.2*10**9, 1.57*10**8, 2*10**9]),
+    ([0.83, 0.815, 0.85, 0.79, 0.69, 0.55],
+     [0.35, 0.55, 0.6, 0.8, 0.75, 2.65],
+     [2.803*10**9, 1.824*10**9, 1.045*10**9, 1.463*10**8, 5*10**8]),
+    ([0.92, 0.86, 0.905, 0.85, 0.69, 0.55],
+     [0.7, 0.85, 0.95, 1.15, 0.95, 2.7],
+     [1.553*10**9, 8.1*10**7, 3.49*10**8, 1.049*10**8, 3*10**8]),
+    ([1.05, 0.95, 1.025, 0.98, 0.69, 0.7],
+     [1.5, 1.7, 1.75, 1.8, 1.5, 2.8],
+     [4.802*10**8, 1.647*10**7, 3.696*10**7, 1.31*10**7, 3.829*10**7]),
+    ([1.45, 1.06, 1.1, 1.05, 0.69, 0.61, 0.67, 0.75, 0.64],
+     [1.99, 2.15, 2.2, 2.4, 1.99, 2.45, 2.15, 2.4, 2.4],
+     [2.212*10**8, 1.042*10**7, 1.033*10**7, 4.505*10**6, 4.238*10**6, 2.51*10**7, 4.08*10**7, 6*10**6]),
+    ([1.285, 1.2, 1.24, 1.18, 0.66, 0.61, 0.65, 0.75, 0.91, 0.69],
+     [2.8, 3, 3.1, 3.17, 2.9, 3.15, 3.05, 3.17, 3.4, 3.38],
+     [6.547*10**7, 2.173*10**6, 1.372*10**6, 7.532*10**5, 4.857*10**5, 6.05*10**6, 1.02*10**6, 9*10**6, 9.3*10**5]),
+    ([1.42, 1.335, 1.38, 1.28, 0.645, 0.6, 0.61, 1.05, 1.13, 0.97],
+     [3.6, 3.9, 3.95, 4, 3.8, 4.02, 3.97, 3.97, 4.25, 4.3],
+     [2.144*10**7, 6.053*10**5, 9.133*10**4, 1.477*10**5, 6.552*10**4, 4.9*10**5, 9.5*10**4, 3.28*10**6, 1.55*10**5]),
+    ([1.515, 1.42, 1.48, 1.26, 1.2, 1.11, 0.98, 0.61],
+     [4.35, 4.6, 4.65, 4.75, 4.8, 4.9, 4.92, 4.9],
+     [1.01*10**7, 2.270*10**5, 7.55*10**4, 7.17*10**5, 6.2*10**5, 1.9*10**5, 3.5*10**4]),
+]
+# Lookup tables built from the tracks. Stage 0 is the zero-age main sequence and
+# stage 1 the end of the main sequence. Entries that depend on the star's mass are NaN.
+stage_T = []
+stage_L = []
+stage_Y = []
+# time at which each post main sequence stage ends, counted from the end of the main sequence
+stage_end = []
+for T, L, Y in stage_tracks:
+    stage_T.append(np.array([np.nan] + T))
+    stage_L.append(np.array([np.nan] + L))
+    stage_Y.append(np.array([0, np.nan] + Y))
+    # the last entry of each track is never entered as a stage
+    stage_end.append(np.cumsum([0] + Y[:-1]))
+
+# Determine the stage of life each star is in, based on its mass and age. Takes
+# arrays of masses and ages and returns arrays of log luminosity and log temperature.
+# Both are 0 for stars whose appearance does not change (low mass stars, and high
+# mass stars still on the main sequence).
+def stages(mass, age, rng=None):
+    rng = np.random.default_rng(rng)
+    mass = np.asarray(mass, dtype=float)
+    age = np.asarray(age, dtype=float)
+    new_L = np.zeros(mass.shape)
+    new_T = np.zeros(mass.shape)
+    # main sequence lifetime
+    life = mass**-2.5*10**10
+    track = np.searchsorted(stage_bins, mass, side="right") - 1
+
     # turn all dying high-mass stars into neutron stars for ease of computation
-    else:
-        if age < mass**-2.5*10**10:
-            return 0,0
-        return np.log10(lum(new_mass("M"))), np.log10(temp(new_mass("O")))
-
-    # iterate over all stages of life for this star
-    for i in range(1, len(T)-1):
-        # if we found the stage this star lives in, determine where it is within the stage
-        if age < Y[i]:
-            Y_delta = (age - Y[i-1]) / (Y[i] - Y[i-1])
-            new_T = T[i] + ((T[i] - T[i-1]) * Y_delta)
-            new_L = L[i] + ((L[i] - L[i-1]) * Y_delta)
-            return new_L + np.random.uniform(-0.07*new_L, 0.07*new_L), new_T + np.random.uniform(-0.07*new_T, 0.07*new_T)
-        age -= Y[i]
-    # if we exit the loop without finding a solution, this star is a white dwarf
-    return np.log10(lum(new_mass("M"))), np.log10(temp(mass))
+    dead = (track == len(stage_tracks)) & (age >= life)
+    n = np.count_nonzero(dead)
+    new_L[dead] = np.log10(lum(new_mass("M", size=n, rng=rng), rng))
+    new_T[dead] = np.log10(temp(new_mass("O", size=n, rng=rng), rng))
+
+    for k in range(len(stage_tracks)):
+        idx = np.flatnonzero(track == k)
+        if idx.size == 0:
+            continue
+        T, L, Y, end = stage_T[k], stage_L[k], stage_Y[k], stage_end[k]
+        m = mass[idx]
+        a = age[idx]
+        ms = life[idx]
+        # find the stage each star lives in; stars past the last stage are white dwarfs
+        i = np.searchsorted(end, a - ms, side="right")
+        i = np.where(a < ms, 1, i + 1)
+        wd = i >= len(T) - 1
+        n = np.count_nonzero(wd)
+        new_L[idx[wd]] = np.log10(lum(new_mass("M", size=n, rng=rng), rng))
+        new_T[idx[wd]] = np.log10(temp(m[wd], rng))
+
+        # determine where each living star is within its stage
+        live = ~wd
+        i, m, a, ms = i[live], m[live], a[live], ms[live]
+        first = i == 1
+        # start of the current stage, and duration of the current and previous stage
+        start = np.where(first, 0, ms + end[np.maximum(i-2, 0)])
+        Y_prev = np.where(first, 0, np.where(i == 2, ms, Y[i-1]))
+        Y_cur = np.where(first, ms, Y[i])
+        T_prev = T[i-1]
+        L_prev = L[i-1]
+        T_prev[first] = np.log10(temp(m[first], rng))
+        L_prev[first] = np.log10(lum(m[first], rng))
+        Y_delta = (a - start - Y_prev) / (Y_cur - Y_prev)
+        T_new = T[i] + ((T[i] - T_prev) * Y_delta)
+        L_new = L[i] + ((L[i] - L_prev) * Y_delta)
+        # jitter by up to 7%. Log values may be negative, and generators need low <= high
+        new_L[idx[live]] = L_new + rng.uniform(-0.07*np.abs(L_new), 0.07*np.abs(L_new))
+        new_T[idx[live]] = T_new + rng.uniform(-0.07*np.abs(T_new), 0.07*np.abs(T_new))
+    return new_L, new_T
+
+# determine the stage of life a single star is in, based on its mass and age
+def stage(mass, age, rng=None):
+    new_L, new_T = stages([mass], [age], rng)
+    return new_L[0], new_T[0]
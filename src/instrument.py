@@ -0,0 +1,121 @@
+'''
+Instrumentation. Stages report what they are doing as spans, counters and progress,
+and the sink decides what happens to it: printed, written as JSON lines, or dropped.
+'''
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+# minimum time between two progress events of a span, in seconds
+progress_interval = 0.5
+
+# Prints events for a person watching. Progress is redrawn in place on a terminal and
+# left out otherwise, so a log file gets a line per stage rather than per update.
+class Console:
+    def __init__(self, stream=None):
+        self.stream = stream
+    def emit(self, event):
+        out = self.stream or sys.stdout
+        kind = event["event"]
+        if kind == "message":
+            print(event["text"], file=out, flush=True)
+        elif kind == "start":
+            print("{:s}...".format(event["label"]), file=out, flush=True)
+        elif kind == "progress":
+            if out.isatty():
+                print("\r{:s}... {:.2f}%".format(event["label"], 100 * event["done"] / event["total"]),
+                      end="", file=out, flush=True)
+        elif kind == "end":
+            counters = ", ".join("{:s}: {}".format(k, v) for k, v in event["counters"].items())
+            print("\r{:s}... Done ({:.2f}s{:s})".format(event["label"], event["elapsed"],
+                  "; " + counters if counters else ""), file=out, flush=True)
+
+# Writes every event as one line of JSON to the file at path. Lines are written whole,
+# so several threads or processes can share a file.
+class JSONLines:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+    def emit(self, event):
+        line = json.dumps(event, default=str) + "\n"
+        with self.lock, open(self.path, "a") as fh:
+            fh.write(line)
+
+# sends every event to several sinks
+class Tee:
+    def __init__(self, *sinks):
+        self.sinks = sinks
+    def emit(self, event):
+        for s in self.sinks:
+            s.emit(event)
+
+# Where events go. None is silent: spans are then a shared do-nothing object, so
+# instrumented loops cost a method call per update and nothing else.
+sink = Console()
+
+def emit(event):
+    if sink is not None:
+        event["time"] = time.time()
+        sink.emit(event)
+
+# a one-off message
+def message(text, **fields):
+    emit(dict(fields, event="message", text=text))
+
+# A stage in progress. Counters are summed with count, or replaced with set, and
+# reported with their rates when the span ends. progress reports how much of total is
+# done, at most once per progress_interval seconds.
+class Span:
+    def __init__(self, name, label, total, fields):
+        self.name = name
+        self.label = label
+        self.total = total
+        self.fields = fields
+        self.counters = {}
+        self.start = time.perf_counter()
+        self.last = self.start
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+    def set(self, key, value):
+        self.counters[key] = value
+    def progress(self, done, total=None):
+        total = total or self.total
+        now = time.perf_counter()
+        if now - self.last < progress_interval or not total:
+            return
+        self.last = now
+        emit({"event": "progress", "span": self.name, "label": self.label, "done": done,
+              "total": total, "rate": done / (now - self.start)})
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+# stands in for a span when instrumentation is off
+class NullSpan:
+    def count(self, key, n=1):
+        pass
+    def set(self, key, value):
+        pass
+    def progress(self, done, total=None):
+        pass
+
+null_span = NullSpan()
+
+# Time the enclosed block as a span called name, shown to people as label.
+# Extra fields are passed along with the start event.
+@contextlib.contextmanager
+def span(name, label=None, total=None, **fields):
+    if sink is None:
+        yield null_span
+        return
+    s = Span(name, label or name, total, fields)
+    emit(dict(fields, event="start", span=name, label=s.label, total=total))
+    try:
+        yield s
+    finally:
+        elapsed = s.elapsed()
+        rates = {k: v / elapsed for k, v in s.counters.items() if isinstance(v, (int, float)) and elapsed > 0}
+        emit({"event": "end", "span": name, "label": s.label, "elapsed": elapsed,
+              "counters": s.counters, "rates": rates})
@@ -0,0 +1,89 @@
+'''
+Runs the stages of generation as a graph of cached nodes.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import numpy as np
+
+import instrument as inst
+import utility as util
+
+# version of the stage results, part of every key. Change it when a stage starts giving
+# different results for the same parameters, so old cached results are not reused.
+version = 2
+
+# A stage of generation. The key of a node is a hash of its name, its parameters and
+# the keys of the nodes it depends on, so it changes whenever anything upstream of it
+# changes. The output path of a node is not part of its key: a node that writes the
+# same result to two places is still the same computation. A node with stream set
+# writes its own result to its cache file as it goes: it is passed the cache path as
+# the path keyword (None when there is no cache), and needs no save function.
+class Node:
+    def __init__(self, name, func, deps=(), params=None, output=None, save=None, load=None, random=False, stream=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.params = params if params is not None else {}
+        self.output = output
+        self.save = save
+        self.load = load
+        self.random = random
+        self.stream = stream
+        self.key = util.cache_key({"version": version, "name": name, "params": self.params,
+                                    "deps": [d.key for d in self.deps]})
+    # seed sequence of this node, derived from its key
+    def seed(self):
+        return np.random.SeedSequence(int(self.key, 16))
+
+# Evaluates nodes on demand. Every result is kept in memory, and the results of nodes
+# with save and load functions are also kept in cache_dir, so a later run only
+# recomputes the nodes whose key has changed. Nodes marked random are passed a seed
+# sequence derived from their key as their last argument, so their result does not
+# depend on which other nodes ran first, ran at the same time, or were loaded from the
+# cache.
+class Pipeline:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.results = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+    # file the result of a node is cached in
+    def path(self, node):
+        return os.path.join(self.cache_dir, "{:s}_{:s}".format(node.name, node.key))
+    # get the result of a node, loading or computing it and its dependencies as needed
+    def get(self, node):
+        mem = (node.key, node.output)
+        if mem in self.results:
+            return self.results[mem]
+        result = None
+        cached = self.cache_dir is not None and node.load is not None
+        if cached:
+            result = node.load(self.path(node))
+            if result is not None:
+                inst.message("Loaded {:s} from cache".format(node.name), node=node.name, key=node.key)
+        if result is None:
+            args = [self.get(d) for d in node.deps]
+            if node.random:
+                args.append(node.seed())
+            if node.stream:
+                result = node.func(*args, path=self.path(node) if cached else None)
+            else:
+                result = node.func(*args)
+                if cached:
+                    node.save(self.path(node), result)
+        self.results[mem] = result
+        return result
+    # Run the given nodes. Their dependencies are resolved first, one at a time, then
+    # the nodes themselves run concurrently on up to workers threads.
+    def run(self, nodes, workers=4):
+        nodes = list({(n.key, n.output): n for n in nodes}.values())
+        for n in nodes:
+            for d in n.deps:
+                self.get(d)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(self.get, n) for n in nodes]
+            return [j.result() for j in jobs]
+    # drop the in-memory results, keeping the cache files
+    def clear(self):
+        self.results.clear()
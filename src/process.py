@@ -2,40 +2,135 @@
 Randomly generates a starscape.
 '''
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import functools
+import itertools
 import numpy as np
 from opensimplex import OpenSimplex
 import os
-import random
+from scipy import ndimage
 import sys
 import time
 
 import utility as util
 import formula as f
+import instrument as inst
+from simplex import ArraySimplex
 
 # parameters
 feature_size = (64, 128.0, 128.0)
 chunk_size = (32, 32, 32)
+# number of workers computing chunks, or None for one per CPU
+workers = None
 
-# internal representation of a star
+# columns of the star catalog
+star_dtype = np.dtype([("x", np.int32), ("y", np.int32), ("z", np.int32),
+                       ("type", np.uint8), ("mass", np.float32), ("cluster", np.uint32),
+                       ("age", np.int64), ("lum", np.float32), ("temp", np.float32),
+                       ("color", np.uint8)])
+
+# Columnar star catalog. Stars are stored as one structured array, so every stage can
+# work on whole columns at once. catalog["mass"] gets a column, catalog[i] gets a Star
+# view of a single star.
+class Catalog:
+    def __init__(self, data):
+        self.data = data
+    # create a catalog of count empty stars
+    @classmethod
+    def empty(cls, count):
+        return cls(np.zeros(count, dtype=star_dtype))
+    # Create a catalog of count empty stars in a record file at path (a .npy file of the
+    # star dtype), memory-mapped so it can be filled in piece by piece without ever
+    # being held in memory.
+    @classmethod
+    def create(cls, path, count):
+        if count == 0:
+            np.save(path, np.zeros(0, dtype=star_dtype))
+            return cls.empty(0)
+        return cls(np.lib.format.open_memmap(path, mode="w+", dtype=star_dtype, shape=(count,)))
+    def __len__(self):
+        return len(self.data)
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        return Star(self, key)
+    def __iter__(self):
+        for i in range(len(self.data)):
+            yield Star(self, i)
+    # positions of all stars, as x, y and z arrays
+    def pos(self):
+        return self.data["x"], self.data["y"], self.data["z"]
+    # spectral class letters of all stars
+    def types(self):
+        return np.array(list(f.spectral_classes))[self.data["type"]]
+    # recalculate the color index column from the temperatures, of all stars or the
+    # stars at idx
+    def update_colors(self, idx=slice(None)):
+        self.data["color"][idx] = f.color_index(self.data["temp"][idx])
+    # memory used by the catalog
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+    # the catalog as consecutive catalogs of at most size stars, which are views of it
+    def blocks(self, size=2**20):
+        for i in range(0, len(self.data), size):
+            yield Catalog(self.data[i:i+size])
+    # write a memory-mapped catalog's changes to its file
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+    # save the catalog to a .npy record file, block by block, so a memory-mapped
+    # catalog is never read into memory whole
+    def save(self, path):
+        with inst.span("save_catalog", "Writing {:s} to disk".format(path)) as span:
+            out = Catalog.create(path, len(self))
+            start = 0
+            for b in self.blocks():
+                out.data[start:start+len(b)] = b.data
+                start += len(b)
+            out.flush()
+            span.count("stars", len(self))
+    # Load a catalog saved with save or created with create, or None if the file does
+    # not exist. With mmap the file is memory-mapped and read lazily, as only the
+    # columns and stars used are read; mmap may also be a numpy.memmap mode such as
+    # "r+" to change the file in place.
+    @classmethod
+    def load(cls, path, mmap=False):
+        if not os.path.exists(path):
+            return None
+        if mmap is True:
+            mmap = "r"
+        return cls(np.load(path, mmap_mode=mmap or None))
+    # a new catalog of the stars at indices idx, for example from a StarIndex query
+    def select(self, idx):
+        return Catalog(self.data[idx])
+
+# internal representation of a star: a view of a single row of a Catalog. Reading or
+# assigning a field reads or writes the catalog.
 class Star:
-    def __init__(self, pos, type, mass, cluster):
-        self.x = pos[0]
-        self.y = pos[1]
-        self.z = pos[2]
-        self.type = type
-        self.mass = mass
-        self.cluster = cluster
-        self._lum = f.lum(self.mass)
-        self._temp = f.temp(self.mass)
-        self.age = 0
-        self._color = ()
+    def __init__(self, catalog, i):
+        i = range(len(catalog))[i]
+        object.__setattr__(self, "_row", catalog.data[i:i+1])
+    def __getattr__(self, name):
+        if name in star_dtype.names and name != "type":
+            return self._row[name][0].item()
+        raise AttributeError(name)
+    def __setattr__(self, name, value):
+        if name == "type":
+            value = f.spectral_classes.index(value)
+        elif name not in star_dtype.names:
+            raise AttributeError("cannot set {:s} on a catalog star".format(name))
+        self._row[name] = value
+    # get this star's spectral class
+    @property
+    def type(self):
+        return f.spectral_classes[self._row["type"][0]]
     # get this star's position
     def pos(self):
         return (self.x, self.y, self.z)
     # get this star's luminosity
     def lum(self):
-        return self._lum
+        return self._row["lum"][0].item()
     # If we use the realistic luminosity for a star when generating an image, we will
     # only be able to see the O-type stars. We use this method to get "luminosity"
     # in the range 0-9, so images look better.
@@ -43,12 +138,173 @@ class Star:
         return  "-MK--GFABO".index(self.type)
     # get this star's temperature
     def temp(self):
-        return self._temp
+        return self._row["temp"][0].item()
     # get this star's color
     def color(self):
-        if self._color == ():
-            self._color = f.color(self.temp())
-        return self._color
+        return f.colors[self._row["color"][0]]
+
+# Sparse storage of cluster labels. Only labelled voxels are kept, as sorted flat
+# indices into the volume plus their labels, using the narrowest integer types that
+# fit the volume and the label count.
+class ClusterMap:
+    def __init__(self, labels):
+        self.shape = tuple(labels.shape)
+        flat = np.flatnonzero(labels)
+        self.count = int(labels.max()) if flat.size > 0 else 0
+        self.index = flat.astype(np.min_scalar_type(max(np.prod(self.shape) - 1, 0)))
+        self.labels = labels.ravel()[flat].astype(np.min_scalar_type(self.count))
+    # get the label of a single voxel, 0 if it is not in a cluster
+    def __getitem__(self, pos):
+        return int(self.lookup(*pos))
+    # get the labels of arrays of voxel positions
+    def lookup(self, x, y, z):
+        flat = np.ravel_multi_index((x, y, z), self.shape)
+        if self.index.size == 0:
+            return np.zeros(np.shape(flat), dtype=self.labels.dtype)
+        i = np.minimum(np.searchsorted(self.index, flat), self.index.size - 1)
+        return np.where(self.index[i] == flat, self.labels[i], 0).astype(self.labels.dtype)
+    # project along the x axis. Each pixel gets the label of its furthest labelled voxel.
+    def project(self):
+        img = np.zeros(self.shape[1:], dtype=self.labels.dtype)
+        plane = self.shape[1] * self.shape[2]
+        pixels = self.index % plane
+        depth = self.index // plane
+        # furthest labelled plane of each pixel, in a single reduction
+        front = np.full(plane, -1, dtype=np.int64)
+        np.maximum.at(front, pixels, depth)
+        top = depth == front[pixels]
+        img.flat[pixels[top]] = self.labels[top]
+        return img
+    # expand back to a full label volume
+    def dense(self):
+        data = np.zeros(self.shape, dtype=self.labels.dtype)
+        data.flat[self.index] = self.labels
+        return data
+    # memory used by the labels
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.labels.nbytes
+    # save the labels to a .npz file
+    def save(self, path, **extra):
+        np.savez(path, shape=self.shape, count=self.count, index=self.index, labels=self.labels, **extra)
+    # load labels saved with save, or None if the file does not exist. Extra arrays
+    # saved alongside the labels are returned as a dict.
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            clusters = cls.__new__(cls)
+            clusters.shape = tuple(int(n) for n in data["shape"])
+            clusters.count = int(data["count"])
+            clusters.index = data["index"]
+            clusters.labels = data["labels"]
+            extra = {k: data[k] for k in data.files if k not in ("shape", "count", "index", "labels")}
+        return clusters, extra
+
+# Spatial index over the stars of a catalog. Space is divided into cells the size of a
+# chunk, and the stars are sorted by the flat index of their cell, so the stars of a
+# row of cells are a contiguous slice found with two binary searches. Queries only look
+# at the cells they overlap. Stars are also grouped by cluster, so the members of a
+# cluster are a single slice. Positions and clusters must not change while the index
+# is in use; other columns, such as ages after aging, may.
+class StarIndex:
+    def __init__(self, stars, cell=None):
+        self.stars = stars
+        self.cell = np.asarray(cell if cell is not None else chunk_size, dtype=np.int64)
+        self.pos = np.stack([stars["x"], stars["y"], stars["z"]], axis=1).astype(np.int64)
+        top = self.pos.max(axis=0) if len(stars) > 0 else np.zeros(3, dtype=np.int64)
+        self.grid = top // self.cell + 1
+        key = self.key(self.pos // self.cell)
+        self.order = np.argsort(key, kind="stable")
+        self.keys = key[self.order]
+        # members of each cluster, as slices of corder
+        cluster = stars["cluster"].astype(np.int64)
+        self.corder = np.argsort(cluster, kind="stable")
+        self.cstarts = np.searchsorted(cluster[self.corder], np.arange(cluster.max(initial=0) + 2))
+    # flat index of cells
+    def key(self, cells):
+        return (cells[..., 0] * self.grid[1] + cells[..., 1]) * self.grid[2] + cells[..., 2]
+    # indices of the stars in every cell overlapping the voxel box lo..hi (exclusive)
+    def candidates(self, lo, hi):
+        lo = np.clip(np.asarray(lo, dtype=np.int64) // self.cell, 0, self.grid - 1)
+        hi = np.clip((np.asarray(hi, dtype=np.int64) - 1) // self.cell, -1, self.grid - 1)
+        if np.any(hi < lo):
+            return np.zeros(0, dtype=np.intp)
+        cx, cy = np.meshgrid(np.arange(lo[0], hi[0]+1), np.arange(lo[1], hi[1]+1), indexing="ij")
+        rows = np.stack([cx.ravel(), cy.ravel(), np.full(cx.size, lo[2])], axis=1)
+        starts = np.searchsorted(self.keys, self.key(rows), side="left")
+        ends = np.searchsorted(self.keys, self.key(rows) + (hi[2] - lo[2]), side="right")
+        if not np.any(ends > starts):
+            return np.zeros(0, dtype=np.intp)
+        return np.concatenate([self.order[s:e] for s, e in zip(starts, ends) if e > s])
+    # indices of the stars with lo <= position < hi
+    def box(self, lo, hi):
+        idx = self.candidates(lo, hi)
+        p = self.pos[idx]
+        inside = np.all((p >= np.asarray(lo)) & (p < np.asarray(hi)), axis=1)
+        return np.sort(idx[inside])
+    # indices of the stars at most r voxels from center
+    def radius(self, center, r):
+        center = np.asarray(center, dtype=float)
+        idx = self.candidates(np.floor(center - r), np.floor(center + r) + 1)
+        d = np.sum((self.pos[idx] - center)**2, axis=1)
+        return np.sort(idx[d <= r*r])
+    # Indices of the k stars nearest to center, nearest first, and their distances. The
+    # search box grows until it holds k stars no further away than its edge.
+    def nearest(self, center, k=1):
+        center = np.asarray(center, dtype=float)
+        k = min(k, len(self.pos))
+        h = float(np.min(self.cell))
+        while True:
+            idx = self.candidates(np.floor(center - h), np.floor(center + h) + 1)
+            d = np.sqrt(np.sum((self.pos[idx] - center)**2, axis=1))
+            covers = np.all(center - h <= 0) and np.all(center + h >= self.grid * self.cell)
+            if idx.size >= k and (k == 0 or np.partition(d, k-1)[k-1] <= h or covers):
+                nearest = np.argsort(d, kind="stable")[:k]
+                return idx[nearest], d[nearest]
+            h *= 2
+    # Number of other stars at most r voxels from each star. Each cell is compared
+    # against the cells within r of it, so only nearby pairs are measured. Members are
+    # compared in batches of at most pairs pairs, one axis at a time, so dense cells
+    # need no more memory than sparse ones.
+    def neighbour_counts(self, r, pairs=2**22):
+        counts = np.zeros(len(self.pos), dtype=np.int64)
+        cells, starts = np.unique(self.keys, return_index=True)
+        bounds = np.append(starts, self.keys.size)
+        for i in range(cells.size):
+            members = self.order[bounds[i]:bounds[i+1]]
+            p = self.pos[members]
+            near = self.pos[self.candidates(np.floor(p.min(axis=0) - r), np.floor(p.max(axis=0) + r) + 1)]
+            # positions are small integers, so their squared distances are exact as floats
+            p, near = p.astype(np.float64), near.astype(np.float64)
+            batch = max(pairs // max(len(near), 1), 1)
+            for j in range(0, len(members), batch):
+                d = np.zeros((min(batch, len(members) - j), len(near)))
+                for axis in range(3):
+                    diff = np.subtract.outer(p[j:j+batch, axis], near[:, axis])
+                    d += np.square(diff, out=diff)
+                counts[members[j:j+batch]] = np.count_nonzero(d <= r*r, axis=1) - 1
+        return counts
+    # indices of the members of a cluster
+    def members(self, label):
+        if label < 0 or label + 1 >= self.cstarts.size:
+            return np.zeros(0, dtype=np.intp)
+        return self.corder[self.cstarts[label]:self.cstarts[label+1]]
+    # Star count, mean age and total and mean luminosity of every cluster, as arrays
+    # indexed by cluster label. Label 0 holds the stars in no cluster.
+    def cluster_stats(self):
+        cluster = self.stars["cluster"].astype(np.intp)
+        n = self.cstarts.size - 1
+        count = np.bincount(cluster, minlength=n)
+        lum = np.bincount(cluster, weights=self.stars["lum"], minlength=n)
+        age = np.bincount(cluster, weights=self.stars["age"], minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return {"count": count, "mean_age": age / count, "total_lum": lum, "mean_lum": lum / count}
+    # Luminosity function of a cluster: the number of its members in each bin of log
+    # luminosity. Returns the counts and the bin edges, as numpy.histogram does.
+    def luminosity_function(self, label, bins=10, range=None):
+        return np.histogram(np.log10(self.stars["lum"][self.members(label)]), bins=bins, range=range)
 
 # map location to probability of star forming there
 def prob_worker(vals):
@@ -68,133 +324,304 @@ def prob_worker(vals):
                                                ((y*chunk_size[1]) + j) / feature_size[1],
                                                ((z*chunk_size[2]) + k) / feature_size[2])
     return x, y, z, chunk
-def probability_map(seed, img_size):
-    # initialize data structures
-    prob = np.zeros(img_size)
-    t = time.time()
-    workers = []
-    threads = os.cpu_count()
-    print("Generating probability map with {:d} threads... 0.00%".format(threads), flush=True, end=" ")
 
+# one array noise generator per seed, shared by all chunks computed in a worker
+@functools.lru_cache(maxsize=None)
+def array_simplex(seed):
+    return ArraySimplex(seed)
+
+# map a whole chunk to probabilities at once. Produces the same values as prob_worker.
+def prob_worker_array(vals):
+    x, y, z, seed = vals
+    simplex = array_simplex(seed)
+    # coordinates along each axis of the chunk, broadcast against each other
+    i = ((x*chunk_size[0]) + np.arange(chunk_size[0])) / feature_size[0]
+    j = ((y*chunk_size[1]) + np.arange(chunk_size[1])) / feature_size[1]
+    k = ((z*chunk_size[2]) + np.arange(chunk_size[2])) / feature_size[2]
+    chunk = simplex.noise3(i[:, None, None], j[None, :, None], k[None, None, :])
+    return x, y, z, chunk
+
+# available noise backends and executors for probability_map. The "simplex" backend
+# evaluates one voxel at a time, "numpy" evaluates whole chunks as arrays.
+backends = {"simplex": prob_worker, "numpy": prob_worker_array}
+executors = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+# Compute chunks in parallel, yielding (cx, cy, cz, chunk) for each one as it
+# completes. At most `window` chunks (default: twice the worker count) are in flight
+# at once, so memory is bounded by the window rather than the number of chunks.
+def generate_chunks(seed, coords, backend="numpy", executor="process", window=None):
+    threads = workers or os.cpu_count()
+    if window is None:
+        window = 2 * threads
+    worker = backends[backend]
+    coords = iter(coords)
+    with executors[executor](max_workers=threads) as pool:
+        # fill the submission window
+        pending = {pool.submit(worker, tuple(c) + (seed,)) for c in itertools.islice(coords, window)}
+        # hand back each chunk as it completes, and replace it with the next one
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for w in finished:
+                yield w.result()
+                for c in itertools.islice(coords, 1):
+                    pending.add(pool.submit(worker, tuple(c) + (seed,)))
+
+# Yield the chunks in coords, loading the ones already in store and computing (and
+# storing) the rest.
+def fetch_chunks(seed, coords, store=None, backend="numpy", executor="process", window=None):
+    coords = [tuple(c) for c in coords]
+    if store is not None:
+        missing = []
+        for c in coords:
+            if store.has(c):
+                yield c + (store.get(c),)
+            else:
+                missing.append(c)
+        coords = missing
+    for cx, cy, cz, chunk in generate_chunks(seed, coords, backend, executor, window):
+        if store is not None:
+            store.put((cx, cy, cz), chunk)
+        yield cx, cy, cz, chunk
+
+# chunk coordinates of all chunks overlapping voxels start (inclusive) to stop (exclusive)
+def chunk_range(start, stop):
+    lo = np.asarray(start) // np.asarray(chunk_size)
+    hi = -(-np.asarray(stop) // np.asarray(chunk_size))
+    return itertools.product(*(range(l, h) for l, h in zip(lo, hi)))
+
+# Copy the parts of the chunks in coords that fall inside start..stop into out,
+# reporting chunks and voxels done to span.
+def assemble(seed, coords, start, stop, out, store=None, backend="numpy", executor="process", window=None, span=inst.null_span):
+    coords = list(coords)
+    start = np.asarray(start)
+    stop = np.asarray(stop)
+    done = 0
+    for cx, cy, cz, res in fetch_chunks(seed, coords, store, backend, executor, window):
+        origin = np.array((cx, cy, cz)) * np.asarray(chunk_size)
+        lo = np.maximum(origin, start)
+        hi = np.minimum(origin + np.asarray(chunk_size), stop)
+        out[tuple(slice(i, j) for i, j in zip(lo - start, hi - start))] = \
+            res[tuple(slice(i, j) for i, j in zip(lo - origin, hi - origin))]
+        done += 1
+        span.count("chunks")
+        span.count("voxels", int(np.prod(hi - lo)))
+        span.progress(done)
+    return out
+
+# label of the span generating the map or a region of it
+def generation_label(label, executor):
+    return "Generating {:s} with {:d} {:s} workers".format(label, workers or os.cpu_count(), executor)
+
+# Generate the probability map chunk by chunk. Chunks are written into the output as
+# they complete. If path is given, the map is written to a raw memory-mapped file
+# there instead of being held in memory. If store is given, chunks already computed
+# for this seed are reused and new ones are saved to it.
+def probability_map(seed, img_size, backend="numpy", executor="process", path=None, window=None, store=None):
+    # initialize data structures
+    if path is None:
+        prob = np.zeros(img_size)
+    else:
+        prob = np.memmap(path, dtype=np.float64, mode="w+", shape=tuple(img_size))
     chunks = (np.asarray(img_size) // np.asarray(chunk_size)).astype(int)
-    # generate chunks in parallel
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        # add all chunks to the thread pool
-        for cx in range(chunks[0]):
-            for cy in range(chunks[1]):
-                for cz in range(chunks[2]):
-                    workers.append(executor.submit(prob_worker, (cx, cy, cz, seed)))
-        # wait for the chunks to complete
-        percent = 0.0
-        while len(workers) != 0:
-            for w in workers:
-                if w.done():
-                    cx, cy, cz, res = w.result()
-                    percent += 100 / (chunks[0]*chunks[1]*chunks[2])
-                    print("\rGenerating probability map with {:d} threads... {:.2f}%".format(threads, percent), flush=True, end=" ")
-                    cx *= chunk_size[0]
-                    cy *= chunk_size[1]
-                    cz *= chunk_size[2]
-                    prob[cx:cx+chunk_size[0], cy:cy+chunk_size[1], cz:cz+chunk_size[2]] = res
-                    workers.remove(w)
-    # normalize distribution to be in range [0, 1]
-    prob = (prob - np.amin(prob))/np.ptp(prob)
-    print("Done. Total time: {:.2f}s".format(time.time() - t))
+    coords = itertools.product(range(chunks[0]), range(chunks[1]), range(chunks[2]))
+    with inst.span("probability_map", generation_label("probability map", executor),
+                   total=int(np.prod(chunks)), seed=seed) as span:
+        assemble(seed, coords, (0, 0, 0), img_size, prob, store, backend, executor, window, span)
+        # normalize distribution to be in range [0, 1], in place
+        prob -= np.amin(prob)
+        prob /= np.ptp(prob)
+        if path is not None:
+            prob.flush()
     return prob
 
-# determine where clusters are located within the probability map
-def find_clusters(prob, cutoff, age, img_size):
-    print("Selecting cluster locations...", end="", flush=True)
-    increment = 100 / img_size[0]
-    percent = 0.00
-    id = 1
-    clusters = np.zeros(img_size).astype(int)
-    locs = prob >= cutoff
-    # iterate over image
-    for x in range(0, img_size[0], 1):
-        for y in range(0, img_size[1], 9):
-            for z in range(0, img_size[2], 9):
-                if locs[x,y,z]:
-                    # calculate index ranges
-                    x1 = np.clip(x-9, 0, img_size[0])
-                    x2 = np.clip(x+10, 0, img_size[0])
-                    y1 = np.clip(y-9, 0, img_size[1])
-                    y2 = np.clip(y+10, 0, img_size[1])
-                    z1 = np.clip(z-9, 0, img_size[2])
-                    z2 = np.clip(z+10, 0, img_size[2])
-                    # get space views
-                    locview = locs[x1:x2, y1:y2, z1:z2]
-                    clusview = clusters[x1:x2, y1:y2, z1:z2]
-                    existing = clusview[clusview > 0]
-                    if existing.size > 0:
-                        clusview[locview] = np.random.choice(existing, clusview[locview].shape)
-                    else:
-                        clusview[locview] = id
-                        id += 1
-        percent += increment
-        print("\rSelecting cluster locations... {:3.2f}%".format(percent), end="", flush=True)
-        # util.write_cluster_image(clusters, img_size, "output/clusters_{:d}".format(x))
-        # input()
-
-    print("\rSelecting cluster locations... 100.0% Done")
+# Get the raw (unnormalized) noise for the box of voxels start..stop without
+# generating the rest of the map. Only the chunks overlapping the box are computed,
+# and with a store only the ones not computed before.
+def probability_region(seed, start, stop, store=None, backend="numpy", executor="process", window=None):
+    region = np.zeros(tuple(np.asarray(stop) - np.asarray(start)))
+    coords = list(chunk_range(start, stop))
+    with inst.span("probability_region", generation_label("probability region", executor),
+                   total=len(coords), seed=seed) as span:
+        assemble(seed, coords, start, stop, region, store, backend, executor, window, span)
+    return region
+
+# Determine where clusters are located within the probability map. Clusters are the
+# connected regions of voxels with probability >= cutoff. Regions at most
+# merge_distance voxels apart are merged into a single cluster, and clusters with
+# fewer than min_size voxels are discarded. connectivity selects which neighbours
+# touch: 1 for faces only, 2 to include edges, 3 to include corners. Labels are
+# returned as a ClusterMap, along with cluster ages drawn from seed.
+def find_clusters(prob, cutoff, age, img_size, merge_distance=9, min_size=1, connectivity=3, seed=None):
+    with inst.span("find_clusters", "Selecting cluster locations") as span:
+        clusters, count = label_clusters(prob, cutoff, merge_distance, min_size, connectivity)
+        span.count("voxels", int(np.prod(np.shape(prob))))
+        span.count("labeled voxels", int(np.count_nonzero(clusters)))
+        span.set("clusters", count)
     # generate ages for each cluster
-    ages = np.zeros(id).astype(np.uint64)
-    for i in range(id):
-        ages[i] = f.new_age(0, age)
-    return clusters, ages
-
-# generate stars in space
-def generate_stars(prob, clusters, count, img_size):
-    print("Generating", count, "stars...", flush=True)
+    ages = f.new_age(0, age, size=count, rng=np.random.default_rng(seed)).astype(np.uint64)
+    return ClusterMap(clusters), ages
+
+# label the clusters of prob for find_clusters, returning the labels and their count
+def label_clusters(prob, cutoff, merge_distance, min_size, connectivity):
+    locs = prob >= cutoff
+    # grow each region so that neighbouring regions touch, label the grown regions,
+    # and keep the labels only where the cutoff is actually met
+    grown = grow_regions(locs, merge_distance)
+    clusters, count = ndimage.label(grown, structure=ndimage.generate_binary_structure(3, connectivity))
+    clusters[~locs] = 0
+    del grown
+    # drop small clusters and renumber the rest consecutively
+    if min_size > 1:
+        ids, count = keep_clusters(np.bincount(clusters.ravel(), minlength=count+1), min_size)
+        clusters = ids.astype(clusters.dtype)[clusters]
+    return clusters, count
+
+# Most planes a region grows by on either side when merging regions at most
+# merge_distance voxels apart. An even distance grows one voxel less on the far side.
+def grow_margin(merge_distance):
+    return merge_distance // 2 if merge_distance > 0 else 0
+
+# Grow the regions of locs so regions at most merge_distance voxels apart touch. The
+# maximum filter grows each region by merge_distance - 1 voxels in total along each
+# axis, split as evenly as it can be between the two sides, so two regions touch
+# exactly when they are at most merge_distance voxels apart, for even distances as well
+# as odd ones.
+def grow_regions(locs, merge_distance):
+    if merge_distance > 0:
+        return ndimage.maximum_filter(locs, size=merge_distance)
+    return locs
+
+# Given the voxel count of each label, the new label of each old one when clusters
+# smaller than min_size are dropped and the rest renumbered consecutively, and the
+# number of clusters kept.
+def keep_clusters(sizes, min_size):
+    keep = sizes >= min_size
+    keep[0] = False
+    ids = np.zeros(sizes.size, dtype=np.int64)
+    count = int(np.count_nonzero(keep))
+    ids[keep] = np.arange(1, count+1)
+    return ids, count
+
+# total probability of each x plane of prob
+def plane_totals(prob):
+    return np.array([np.sum(plane, dtype=np.float64) for plane in prob])
+
+# Split count samples between planes with total probabilities totals, so every plane
+# can then be sampled on its own.
+def split_count(totals, count, rng):
+    return rng.multinomial(count, totals / np.sum(totals))
+
+# Draw count (y, z) positions in a single plane, each with probability proportional to
+# the plane at that voxel, by inverse transform sampling on the plane's cumulative sum.
+def sample_plane(plane, count, rng):
+    cdf = np.cumsum(plane, dtype=np.float64).ravel()
+    u = rng.random(count) * cdf[-1]
+    flat = np.minimum(np.searchsorted(cdf, u, side="right"), cdf.size - 1)
+    return np.unravel_index(flat, plane.shape)
+
+# Generate stars in space, returned as a Catalog ordered by x plane. Each star lands on
+# a voxel with probability proportional to prob there: star_plan splits the stars
+# between x planes by their total probability, and fill_stars places each plane's
+# stars with sample_plane, so only one plane's cumulative sum is held at a time. The
+# class quotas and their order come from one substream of seed, and the positions and
+# physical properties of each plane's stars from the plane's own substreams, so any
+# range of planes can be generated without the others. If path is given, the catalog is streamed plane by
+# plane into a record file there (see Catalog.create) instead of being built in memory.
+def generate_stars(prob, clusters, count, img_size, seed=None, path=None):
+    seq = util.seed_sequence(seed)
+    with inst.span("generate_stars", "Generating {:d} stars".format(count), total=np.shape(prob)[0]) as span:
+        quotas, types, per_plane = star_plan(plane_totals(prob), count, seq)
+        for c, n in zip(f.spectral_classes, quotas):
+            span.set(c + " type stars", int(min(n, count)))
+        stars = Catalog.empty(count) if path is None else Catalog.create(path, count)
+        fill_stars(stars, prob, clusters, per_plane, types, seq, span=span)
+        stars.flush()
+        span.count("stars", count)
+    return stars
+
+# The parts of generate_stars that depend on the whole volume, given the total
+# probability of each plane: the number of stars of each class, the class of every
+# star in catalog order, and the number of stars in each plane.
+def star_plan(totals, count, seed=None):
+    seq = util.seed_sequence(seed)
+    rng = util.substream(seq, 2)
     # determine number of stars per spectral class using the Initial Mass Function
     # This is before age is taken into account
-    classes = {}
-    for c in "OBAFGKM":
-        classes[c] = f.imf(f.new_mass(c))
+    weights = f.imf(f.new_mass(np.arange(len(f.spectral_classes)), rng=rng))
     # calculate ratios and thus total number of stars of a given type
-    total_imf = sum(classes.values())
-    for c in "OBAFGKM":
-        classes[c] = int(np.ceil(classes[c] / total_imf * count))
-        print(c, "type stars:", classes[c])
-
-    # generate stars
-    stars = []
-    while len(stars) < count:
-        # randomly generate x, y, and z positions within the dimensions of the probability map
-        pos = (np.random.randint(img_size[0]),
-               np.random.randint(img_size[1]),
-               np.random.randint(img_size[2]))
-        # Get a random value in the range 0-1. If less than the probability at the star's location, save it.
-        if np.random.random() < prob[pos]:
-            avail = "OBAFGKM"
-            # determine star's spectral class
-            c = random.choice(avail)
-            while(classes[c] == 0):
-                avail.replace(c, "")
-                c = random.choice(avail)
-            classes[c] -= 1
-            # save star.
-            s = Star(pos, c, f.new_mass(c), clusters[pos])
-            stars.append(s)
-        print("\r{:.2f}%".format(len(stars) / count * 100), end=" ")
-    print("Done")
-    return stars
+    quotas = np.ceil(weights / np.sum(weights) * count).astype(int)
+    # hand out the classes' quotas in random order
+    types = rng.permutation(np.repeat(np.arange(len(f.spectral_classes), dtype=np.uint8), quotas))[:count]
+    return quotas, types, split_count(totals, count, util.substream(seq, 0))
+
+# Fill in stars plane by plane, given the stars in each plane of prob and their
+# classes. prob and clusters may be a slab of the volume starting at plane x0, in
+# which case per_plane and types cover only the slab's stars.
+def fill_stars(stars, prob, clusters, per_plane, types, seed=None, x0=0, span=inst.null_span):
+    seq = util.seed_sequence(seed)
+    c = stars.data
+    c["type"] = types
+    start = 0
+    for i in np.flatnonzero(per_plane):
+        x = x0 + i
+        sl = slice(start, start+per_plane[i])
+        c["x"][sl] = x
+        c["y"][sl], c["z"][sl] = sample_plane(prob[i], per_plane[i], util.substream(seq, 1, x))
+        c["cluster"][sl] = clusters.lookup(c["x"][sl] - x0, c["y"][sl], c["z"][sl])
+        # physical properties
+        prng = util.substream(seq, 3, int(x))
+        c["mass"][sl] = f.new_mass(c["type"][sl], rng=prng)
+        c["lum"][sl] = f.lum(c["mass"][sl], prng)
+        c["temp"][sl] = f.temp(c["mass"][sl], prng)
+        stars.update_colors(sl)
+        span.count("cluster stars", int(np.count_nonzero(c["cluster"][sl])))
+        span.progress(i + 1)
+        start += per_plane[i]
+
+# The stars of each x plane, as (plane, index) pairs. Catalogs from generate_stars are
+# ordered by plane, so each plane is a slice of them; other catalogs are sorted first.
+def plane_groups(x):
+    if np.all(x[1:] >= x[:-1]):
+        ends = np.append(np.flatnonzero(x[1:] != x[:-1]) + 1, len(x))
+        starts = np.append(0, ends[:-1])
+        return [(int(x[s]), slice(s, e)) for s, e in zip(starts, ends) if e > s]
+    order = np.argsort(x, kind="stable")
+    planes, starts = np.unique(x[order], return_index=True)
+    return list(zip(planes.tolist(), np.split(order, starts[1:])))
 
-# age each star
-def age_stars(stars, cluster_ages, universe):
-    print("Aging stars... ", end="", flush=True)
-    percent = 0
-    for star in stars:
-        # if star is in a cluster, use the cluster's age
-        if star.cluster > 0:
-            star.age = cluster_ages[star.cluster-1]
-        # otherwise, get a new age
-        else:
-            star.age = f.new_age(0, universe)
-        # determine the phase of life a star is in
-        new_lum, new_temp = f.stage(star.mass, star.age)
-        if new_lum != 0 or new_temp != 0:
-            star._lum = 10**new_lum
-            star._temp = 10**new_temp
-    print("Done")
+# Age each star. The stars of each x plane draw from the plane's own substream of
+# seed, in catalog order, so any set of planes can be aged without the others.
+# Stars are aged in place, unless path is given: then the aged catalog is streamed,
+# plane by plane, into a new record file there and the original is left as it was.
+def age_stars(stars, cluster_ages, universe, seed=None, path=None):
+    seq = util.seed_sequence(seed)
+    groups = plane_groups(stars["x"])
+    src = stars.data
+    if path is not None:
+        stars = Catalog.create(path, len(stars))
+    c = stars.data
+    with inst.span("age_stars", "Aging stars", total=len(groups)) as span:
+        for done, (x, idx) in enumerate(groups):
+            rng = util.substream(seq, x)
+            if path is not None:
+                c[idx] = src[idx]
+            # if star is in a cluster, use the cluster's age, otherwise get a new age
+            cluster = c["cluster"][idx]
+            member = cluster > 0
+            ages = np.zeros(cluster.size, dtype=np.int64)
+            ages[member] = cluster_ages[cluster[member].astype(np.intp)-1]
+            ages[~member] = f.new_age(0, universe, size=np.count_nonzero(~member), rng=rng)
+            c["age"][idx] = ages
+            # determine the phase of life each star is in
+            new_lum, new_temp = f.stages(c["mass"][idx], ages, rng)
+            changed = (new_lum != 0) | (new_temp != 0)
+            lum, temp = c["lum"][idx], c["temp"][idx]
+            lum[changed] = 10**new_lum[changed]
+            temp[changed] = 10**new_temp[changed]
+            c["lum"][idx], c["temp"][idx] = lum, temp
+            stars.update_colors(idx)
+            span.count("stars", cluster.size)
+            span.count("evolved stars", int(np.count_nonzero(changed)))
+            span.progress(done + 1)
+        stars.flush()
     return stars
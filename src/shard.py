@@ -0,0 +1,386 @@
+'''
+Sharded generation. The volume is split along x into slabs of whole chunks, and each
+slab is generated by its own task: its noise, its cluster labels, its stars and its
+parts of the images. A coordinator merges the clusters that cross slab boundaries and
+reduces the partial results. Tasks run on a backend: local worker processes, or a
+file-based work queue that workers on any machine sharing the directory can take
+tasks from.
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import numpy as np
+import os
+import shutil
+import sys
+import time
+import traceback
+import uuid
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import formula as f
+import instrument as inst
+import process as proc
+import utility as util
+
+# Split the x planes of a volume into shards slabs of whole chunks, as (x0, x1) pairs.
+# There are never more slabs than chunks along x.
+def slabs(img_size, shards):
+    chunks = img_size[0] // proc.chunk_size[0]
+    parts = np.array_split(np.arange(chunks), min(shards, chunks))
+    return [(int(p[0]) * proc.chunk_size[0], (int(p[-1]) + 1) * proc.chunk_size[0]) for p in parts]
+
+# directory holding the intermediate files of shard k
+def shard_dir(job, k):
+    return os.path.join(job["work"], "shard_{:d}".format(k))
+
+# set up this process for a job, which may have been made on another machine
+def configure(job):
+    proc.feature_size = tuple(job["feature_size"])
+    proc.chunk_size = tuple(job["chunk_size"])
+
+# Raw noise of slab k, written to the shard's directory. Returns its smallest and
+# largest values, so the coordinator can normalize the map as a whole.
+def noise_task(job, k):
+    configure(job)
+    x0, x1 = job["slabs"][k]
+    size = job["img_size"]
+    store = None
+    if job["chunk_store"] is not None:
+        store = util.ChunkStore(job["chunk_store"], job["seed"], proc.feature_size, proc.chunk_size)
+    raw = proc.probability_region(job["seed"], (x0, 0, 0), (x1, size[1], size[2]), store, executor=job["executor"])
+    os.makedirs(shard_dir(job, k), exist_ok=True)
+    np.save(os.path.join(shard_dir(job, k), "noise.npy"), raw)
+    return [float(np.amin(raw)), float(np.amax(raw))]
+
+# The normalized, reduced probability of planes x0 to x1, read from the raw noise of
+# whichever slabs hold them.
+def reduced_planes(job, x0, x1):
+    parts = []
+    for k, (s0, s1) in enumerate(job["slabs"]):
+        lo, hi = max(x0, s0), min(x1, s1)
+        if lo < hi:
+            raw = np.load(os.path.join(shard_dir(job, k), "noise.npy"), mmap_mode="r")
+            parts.append(raw[lo-s0:hi-s0])
+    raw = np.concatenate(parts)
+    mn, mx = job["range"]
+    # the same operations, in the same order and precision, as normalizing and caching
+    # the whole map
+    prob = ((raw - mn) / (mx - mn)).astype(job["dtype"])
+    return np.power(prob, job["reduction"])
+
+# Label the clusters of slab k on their own. Regions are grown across the slab's faces
+# by reading grow_margin planes of the neighbouring slabs, so the grown regions inside
+# the slab are exactly those of the whole volume. Saves the local labels, the labels of
+# the boundary planes before masking (for merging), the size of every local cluster,
+# the total probability of each plane and the reduced slab. Returns the label count.
+def label_task(job, k):
+    configure(job)
+    x0, x1 = job["slabs"][k]
+    g = proc.grow_margin(job["merge_distance"])
+    h0, h1 = max(x0 - g, 0), min(x1 + g, job["img_size"][0])
+    prob = reduced_planes(job, h0, h1)
+    locs = prob >= job["cutoff"]
+    grown = proc.grow_regions(locs, job["merge_distance"])[x0-h0:x1-h0]
+    locs, prob = locs[x0-h0:x1-h0], prob[x0-h0:x1-h0]
+    labels, count = ndimage.label(grown, structure=ndimage.generate_binary_structure(3, job["connectivity"]))
+    del grown
+    first, last = labels[0].copy(), labels[-1].copy()
+    labels[~locs] = 0
+    d = shard_dir(job, k)
+    np.save(os.path.join(d, "reduced.npy"), prob)
+    proc.ClusterMap(labels).save(os.path.join(d, "labels.npz"))
+    np.savez(os.path.join(d, "boundary.npz"), first=first, last=last,
+             sizes=np.bincount(labels.ravel(), minlength=count+1), totals=proc.plane_totals(prob))
+    return count
+
+# Pairs of labels of two neighbouring planes, last before first, that touch under the
+# dx = +1 layer of structure.
+def boundary_edges(last, first, structure):
+    Y, Z = last.shape
+    pairs = []
+    for dy, dz in zip(*np.nonzero(structure[2])):
+        dy, dz = dy - 1, dz - 1
+        a = last[max(-dy, 0):Y-max(dy, 0), max(-dz, 0):Z-max(dz, 0)]
+        b = first[max(dy, 0):Y-max(-dy, 0), max(dz, 0):Z-max(-dz, 0)]
+        touch = (a > 0) & (b > 0)
+        pairs.append(np.stack((a[touch], b[touch]), axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+# Merge the local labels of every slab into the labels of the whole volume. Each local
+# label gets a provisional id, its slab's offset plus its label, and the provisional
+# ids that touch across a slab boundary are joined. Clusters are numbered by their
+# smallest provisional id, which is the order in which labelling the whole volume
+# would number them, then small clusters are dropped as in find_clusters. Returns the
+# new label of every provisional id, the offsets, the cluster count, and the total
+# probability of each plane.
+def merge_labels(job, counts):
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    n = int(np.sum(counts))
+    structure = ndimage.generate_binary_structure(3, job["connectivity"])
+    bounds = [np.load(os.path.join(shard_dir(job, k), "boundary.npz")) for k in range(len(counts))]
+    edges = [np.zeros((0, 2), dtype=np.int64)]
+    for k in range(len(counts) - 1):
+        pairs = boundary_edges(bounds[k]["last"], bounds[k+1]["first"], structure).astype(np.int64)
+        edges.append(pairs + (offsets[k], offsets[k+1]))
+    edges = np.concatenate(edges) - 1
+    graph = coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n))
+    found, comp = connected_components(graph, directed=False)
+    first = np.full(found, n)
+    np.minimum.at(first, comp, np.arange(n))
+    rank = np.empty(found, dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(found)
+    ids = np.zeros(n + 1, dtype=np.int64)
+    ids[1:] = rank[comp] + 1
+    count = found
+    if job["min_size"] > 1:
+        sizes = np.concatenate([b["sizes"][1:] for b in bounds])
+        keep, count = proc.keep_clusters(np.bincount(ids[1:], weights=sizes, minlength=found+1), job["min_size"])
+        ids = keep[ids]
+    totals = np.concatenate([b["totals"] for b in bounds])
+    return ids, offsets, count, totals
+
+# Generate and age the stars of slab k into the shard's catalog, and project its parts
+# of the distribution and cluster images. Returns the range of the stars' distance
+# modifiers at each exposure.
+def stars_task(job, k):
+    x0, x1 = job["slabs"][k]
+    d = shard_dir(job, k)
+    prob = np.load(os.path.join(d, "reduced.npy"), mmap_mode="r")
+    ids = np.load(os.path.join(job["work"], "ids.npy"))
+    local = proc.ClusterMap.load(os.path.join(d, "labels.npz"))[0].dense()
+    clusters = proc.ClusterMap(np.where(local > 0, ids[local.astype(np.int64) + job["offsets"][k]], 0))
+    del local
+    np.save(os.path.join(d, "cluster_img.npy"), clusters.project())
+    weights = util.depth_weights(job["img_size"][0])[x0:x1]
+    np.save(os.path.join(d, "dist_img.npy"), util.project_depth(prob, weights, 0, job["img_size"][1], 0, job["img_size"][2]))
+    per_plane = np.load(os.path.join(job["work"], "per_plane.npy"))
+    start = int(np.sum(per_plane[:x0]))
+    types = np.load(os.path.join(job["work"], "types.npy"), mmap_mode="r")[start:start+int(np.sum(per_plane[x0:x1]))]
+    stars = proc.Catalog.create(os.path.join(d, "stars.npy"), len(types))
+    with inst.span("generate_stars", "Generating {:d} stars of shard {:d}".format(len(types), k), total=x1-x0) as span:
+        proc.fill_stars(stars, prob, clusters, per_plane[x0:x1], types, np.random.SeedSequence(job["seeds"]["stars"]), x0, span)
+        stars.flush()
+        span.count("stars", len(types))
+    ages = np.load(os.path.join(job["work"], "ages.npy"))
+    aged = proc.age_stars(stars, ages, job["universe"], np.random.SeedSequence(job["seeds"]["aged"]),
+                          os.path.join(d, "aged.npy"))
+    return [[float(lo), float(hi)] for lo, hi in util.mod_ranges(aged, [e[1] for e in job["exposures"]])]
+
+# Render the aged stars of slab k at every exposure, normalized to the ranges of the
+# whole catalog.
+def render_task(job, k):
+    d = shard_dir(job, k)
+    stars = proc.Catalog.load(os.path.join(d, "aged.npy"), mmap=True)
+    imgs = util.render_stars(stars, job["img_size"], [e[1] for e in job["exposures"]], ranges=job["ranges"])
+    np.save(os.path.join(d, "star_imgs.npy"), np.stack(imgs))
+    return len(stars)
+
+tasks = {"noise": noise_task, "label": label_task, "stars": stars_task, "render": render_task}
+
+# runs a task by name, so backends only pass names around
+def run_task(name, job, k):
+    return tasks[name](job, k)
+
+# Runs the tasks of a job on up to workers local processes. Each process generates its
+# noise on threads, as processes already run in parallel.
+class LocalBackend:
+    executor = "thread"
+    def __init__(self, workers=None):
+        self.workers = workers
+    def map(self, name, job, shards):
+        with ProcessPoolExecutor(max_workers=self.workers or len(shards)) as pool:
+            jobs = [pool.submit(run_task, name, job, k) for k in shards]
+            return [j.result() for j in jobs]
+
+# write obj as JSON to path in one step, so readers never see a partial file
+def write_json(path, obj):
+    tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    with open(tmp, "w") as fh:
+        json.dump(obj, fh)
+    os.replace(tmp, path)
+
+# Claim the oldest pending task of the queue at root, returning its file in the claimed
+# directory, or None if there is nothing to do. Claiming is a rename, so only one
+# worker gets each task.
+def claim(root):
+    pending = os.path.join(root, "pending")
+    for name in sorted(os.listdir(pending)):
+        if name.startswith("."):
+            continue
+        path = os.path.join(root, "claimed", name)
+        try:
+            os.rename(os.path.join(pending, name), path)
+        except FileNotFoundError:
+            continue
+        return path
+    return None
+
+# run a claimed task, recording its result, or the error it raised, as done
+def work(root, path):
+    with open(path) as fh:
+        task = json.load(fh)
+    try:
+        out = {"result": run_task(task["task"], task["job"], task["shard"])}
+    except Exception:
+        out = {"error": traceback.format_exc()}
+    write_json(os.path.join(root, "done", os.path.basename(path)), out)
+    os.remove(path)
+
+# Runs the tasks of a job through a queue of files under root: pending tasks, tasks
+# claimed by a worker, and the results of done tasks. Workers are started with
+# `python shard.py worker root` on any machine that sees root and the job's work
+# directory. With work set, the coordinator also takes tasks while it waits, so a
+# queue with no other workers still finishes.
+class QueueBackend:
+    executor = "process"
+    def __init__(self, root, poll=0.2, work=True):
+        self.root = root
+        self.poll = poll
+        self.work = work
+        for d in ("pending", "claimed", "done"):
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+    def map(self, name, job, shards):
+        # task files are named by submission time first, so sorting them by name puts the
+        # oldest first
+        run = "{:020d}_{:s}".format(time.time_ns(), uuid.uuid4().hex[:12])
+        ids = ["{:s}_{:s}_{:d}.json".format(run, name, k) for k in shards]
+        for tid, k in zip(ids, shards):
+            write_json(os.path.join(self.root, "pending", tid), {"task": name, "job": job, "shard": k})
+        results = {}
+        while len(results) < len(ids):
+            for tid in ids:
+                path = os.path.join(self.root, "done", tid)
+                if tid not in results and os.path.exists(path):
+                    with open(path) as fh:
+                        results[tid] = json.load(fh)
+                    os.remove(path)
+            if len(results) == len(ids):
+                break
+            path = claim(self.root) if self.work else None
+            if path is not None:
+                work(self.root, path)
+            else:
+                time.sleep(self.poll)
+        for tid in ids:
+            if "error" in results[tid]:
+                raise RuntimeError("task {:s} failed:\n{:s}".format(tid, results[tid]["error"]))
+        return [results[tid]["result"] for tid in ids]
+
+# stop file of the queue at root, or 0 if it has never been stopped
+def stopped(root):
+    try:
+        return os.path.getmtime(os.path.join(root, "stop"))
+    except OSError:
+        return 0
+
+# Take tasks from the queue at root until it is stopped (see main).
+def worker(root, poll=0.2):
+    QueueBackend(root)
+    start = stopped(root)
+    while stopped(root) == start:
+        path = claim(root)
+        if path is not None:
+            work(root, path)
+        else:
+            time.sleep(poll)
+
+# Generate one run of params in shards slabs on backend, writing the same files as the
+# pipeline: the distribution into dirs[0], the cluster image into dirs[1], and the star
+# images, HR diagram and catalog into dirs[2]. seeds holds the seed of every random
+# stage (see starscape.stage_seeds), so the results are those of an unsharded run, apart
+# from rounding in the distribution image, which is summed slab by slab. Intermediate
+# files go in work, which workers on other machines must be able to reach, and are
+# removed when the run ends, whether it succeeded or not. Noise chunks are kept in and reused from the chunk
+# store in store_dir, if one is given. hr_mode is the mode of the HR diagram (see
+# util.write_HR_diagram).
+def run(params, dirs, backend, seeds, img_size, exposures, shards, work=None,
+        merge_distance=9, min_size=1, connectivity=3, dtype=np.float32, store_dir=None, hr_mode="auto"):
+    work = os.path.abspath(work or os.path.join(dirs[2], "shards"))
+    os.makedirs(work, exist_ok=True)
+    parts = slabs(img_size, shards)
+    job = {"seed": params["seed"], "img_size": [int(n) for n in img_size], "slabs": parts,
+           "feature_size": [float(n) for n in proc.feature_size], "chunk_size": [int(n) for n in proc.chunk_size],
+           "reduction": params["reduction"], "cutoff": params["cutoff"], "universe": params["universe"],
+           "merge_distance": merge_distance, "min_size": min_size, "connectivity": connectivity,
+           "dtype": np.dtype(dtype).name, "seeds": seeds, "executor": backend.executor, "work": work,
+           "chunk_store": os.path.abspath(store_dir) if store_dir is not None else None,
+           "exposures": [[os.path.abspath(name), distance] for name, distance in exposures]}
+    ks = list(range(len(parts)))
+    try:
+        with inst.span("sharded", "Generating in {:d} shards".format(len(parts)), total=4, seed=params["seed"]) as span:
+            ranges = backend.map("noise", job, ks)
+            job["range"] = [min(r[0] for r in ranges), max(r[1] for r in ranges)]
+            span.progress(1)
+            counts = backend.map("label", job, ks)
+            with inst.span("merge_clusters", "Merging clusters across shards"):
+                ids, offsets, count, totals = merge_labels(job, counts)
+                ages = f.new_age(0, params["universe"], size=count,
+                                 rng=np.random.default_rng(np.random.SeedSequence(seeds["clusters"]))).astype(np.uint64)
+                quotas, types, per_plane = proc.star_plan(totals, params["count"], np.random.SeedSequence(seeds["stars"]))
+                for name, arr in (("ids", ids), ("ages", ages), ("types", types), ("per_plane", per_plane)):
+                    np.save(os.path.join(work, name + ".npy"), arr)
+            job["offsets"] = [int(o) for o in offsets]
+            span.set("clusters", count)
+            span.progress(2)
+            ranges = backend.map("stars", job, ks)
+            job["ranges"] = [[min(r[i][0] for r in ranges), max(r[i][1] for r in ranges)] for i in range(len(exposures))]
+            span.progress(3)
+            backend.map("render", job, ks)
+            reduce(job, count, dirs, hr_mode)
+            span.count("stars", params["count"])
+    finally:
+        # the slabs are as large as the map itself, so they are not kept even if a task fails
+        shutil.rmtree(work, ignore_errors=True)
+
+# Combine the partial results of every shard into the images and catalog
+def reduce(job, count, dirs, hr_mode="auto"):
+    img_size = job["img_size"]
+    ks = range(len(job["slabs"]))
+    dist = sum(np.load(os.path.join(shard_dir(job, k), "dist_img.npy")) for k in ks)
+    util.save_dist_img(dist, img_size, os.path.join(dirs[0], "distribution"))
+    # the furthest shard with a label in a pixel holds its furthest labelled voxel
+    labels = np.zeros(img_size[1:], dtype=np.int64)
+    for k in ks:
+        part = np.load(os.path.join(shard_dir(job, k), "cluster_img.npy"))
+        labels[part > 0] = part[part > 0]
+    util.write_cluster_labels(labels, count, img_size, os.path.join(dirs[1], "clusters"),
+                              seed=np.random.SeedSequence(job["seeds"]["cluster_image"]))
+    # splatting keeps the brightest value, so the partial images combine the same way
+    imgs = np.load(os.path.join(shard_dir(job, 0), "star_imgs.npy"))
+    for k in ks[1:]:
+        np.maximum(imgs, np.load(os.path.join(shard_dir(job, k), "star_imgs.npy")), out=imgs)
+    util.save_star_images(imgs, job["exposures"])
+    parts = [proc.Catalog.load(os.path.join(shard_dir(job, k), "aged.npy"), mmap=True) for k in ks]
+    with inst.span("save_catalog", "Writing catalog to disk"):
+        catalog = proc.Catalog.create(os.path.join(dirs[2], "catalog.npy"), sum(len(p) for p in parts))
+        start = 0
+        for p in parts:
+            for block in p.blocks():
+                catalog.data[start:start+len(block)] = block.data
+                start += len(block)
+        catalog.flush()
+    util.write_HR_diagram(catalog, os.path.join(dirs[2], "HR"), hr_mode)
+
+parser = argparse.ArgumentParser(description="Works on the tasks of sharded starscape generation.")
+commands = parser.add_subparsers(dest="command", required=True)
+worker_parser = commands.add_parser("worker", help="take tasks from a queue until it is stopped")
+worker_parser.add_argument("queue", help="queue directory")
+worker_parser.add_argument("--poll", type=float, default=0.2, help="seconds between checks for new tasks (default: 0.2)")
+stop_parser = commands.add_parser("stop", help="stop every worker running on a queue")
+stop_parser.add_argument("queue", help="queue directory")
+
+def main(argv):
+    args = parser.parse_args(argv)
+    if args.command == "worker":
+        worker(args.queue, args.poll)
+    else:
+        # workers stop when the stop file changes, so workers started later keep running
+        with open(os.path.join(args.queue, "stop"), "w") as fh:
+            fh.write(str(time.time()))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
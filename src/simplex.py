@@ -0,0 +1,370 @@
+'''
+Array-based OpenSimplex noise. A vectorized port of the 3D noise function from
+opensimplex 0.3 (OpenSimplex.noise3d) that evaluates whole blocks of coordinates
+at once. Every branch and every floating point expression follows the original,
+so the results are identical to calling noise3d point by point.
+'''
+import numpy as np
+
+STRETCH_CONSTANT_3D = -1.0 / 6              # (1/Math.sqrt(3+1)-1)/3
+SQUISH_CONSTANT_3D = 1.0 / 3                # (Math.sqrt(3+1)-1)/3
+NORM_CONSTANT_3D = 103
+
+# Gradients for 3D. They approximate the directions to the vertices of a
+# rhombicuboctahedron from the center.
+GRADIENTS_3D = np.array([
+    -11,  4,  4,     -4,  11,  4,    -4,  4,  11,
+     11,  4,  4,      4,  11,  4,     4,  4,  11,
+    -11, -4,  4,     -4, -11,  4,    -4, -4,  11,
+     11, -4,  4,      4, -11,  4,     4, -4,  11,
+    -11,  4, -4,     -4,  11, -4,    -4,  4, -11,
+     11,  4, -4,      4,  11, -4,     4,  4, -11,
+    -11, -4, -4,     -4, -11, -4,    -4, -4, -11,
+     11, -4, -4,      4, -11, -4,     4, -4, -11,
+], dtype=np.int64).reshape(-1, 3)
+
+# emulate the signed 64-bit overflow of the seeding LCG
+def overflow(x):
+    return ((x + 2**63) % 2**64) - 2**63
+
+# pick one vertex (xsv, ysv, zsv, dx, dy, dz) per point. conds and vertices work
+# like np.select, with the last vertex used as the default.
+def pick(conds, vertices):
+    return tuple(np.select(conds, [v[k] for v in vertices[:-1]], vertices[-1][k]) for k in range(6))
+
+class ArraySimplex:
+    # build the same permutation table as OpenSimplex(seed)
+    def __init__(self, seed=0):
+        perm = np.zeros(256, dtype=np.int64)
+        source = list(range(256))
+        seed = overflow(seed * 6364136223846793005 + 1442695040888963407)
+        seed = overflow(seed * 6364136223846793005 + 1442695040888963407)
+        seed = overflow(seed * 6364136223846793005 + 1442695040888963407)
+        for i in range(255, -1, -1):
+            seed = overflow(seed * 6364136223846793005 + 1442695040888963407)
+            r = int((seed + 31) % (i + 1))
+            if r < 0:
+                r += i + 1
+            perm[i] = source[r]
+            source[r] = source[i]
+        self._perm = perm
+        # gradient for each permutation entry
+        self._grad = GRADIENTS_3D[perm % len(GRADIENTS_3D)]
+
+    def _extrapolate(self, xsb, ysb, zsb, dx, dy, dz):
+        perm = self._perm
+        g = self._grad[(perm[(perm[xsb & 0xFF] + ysb) & 0xFF] + zsb) & 0xFF]
+        return g[:, 0] * dx + g[:, 1] * dy + g[:, 2] * dz
+
+    # add the contribution of a single lattice vertex to value, where it has one
+    def _contribute(self, value, xsv, ysv, zsv, dx, dy, dz):
+        attn = 2 - dx * dx - dy * dy - dz * dz
+        inside = attn > 0
+        if not np.any(inside):
+            return value
+        attn = attn * attn
+        return np.where(inside, value + attn * attn * self._extrapolate(xsv, ysv, zsv, dx, dy, dz), value)
+
+    # generate 3D noise for arrays of coordinates. x, y and z are broadcast
+    # against each other, and the result has the broadcast shape.
+    def noise3(self, x, y, z):
+        x, y, z = np.broadcast_arrays(*(np.asarray(a, dtype=np.float64) for a in (x, y, z)))
+        shape = x.shape
+        x, y, z = x.ravel(), y.ravel(), z.ravel()
+
+        # Place input coordinates on simplectic honeycomb.
+        stretch_offset = (x + y + z) * STRETCH_CONSTANT_3D
+        xs = x + stretch_offset
+        ys = y + stretch_offset
+        zs = z + stretch_offset
+
+        # Floor to get simplectic honeycomb coordinates of rhombohedron super-cell origin.
+        xsb = np.floor(xs)
+        ysb = np.floor(ys)
+        zsb = np.floor(zs)
+
+        # Skew out to get actual coordinates of rhombohedron origin.
+        squish_offset = (xsb + ysb + zsb) * SQUISH_CONSTANT_3D
+        xb = xsb + squish_offset
+        yb = ysb + squish_offset
+        zb = zsb + squish_offset
+
+        # Compute simplectic honeycomb coordinates relative to rhombohedral origin.
+        xins = xs - xsb
+        yins = ys - ysb
+        zins = zs - zsb
+        in_sum = xins + yins + zins
+
+        # Positions relative to origin point.
+        dx0 = x - xb
+        dy0 = y - yb
+        dz0 = z - zb
+
+        args = (xsb.astype(np.int64), ysb.astype(np.int64), zsb.astype(np.int64),
+                xins, yins, zins, in_sum, dx0, dy0, dz0)
+        value = np.zeros(x.shape)
+        low = in_sum <= 1
+        high = ~low & (in_sum >= 2)
+        for region, mask in ((self._low, low), (self._high, high), (self._middle, ~(low | high))):
+            idx = np.nonzero(mask)[0]
+            if idx.size > 0:
+                value[idx] = region(*(a[idx] for a in args))
+        return (value / NORM_CONSTANT_3D).reshape(shape)
+
+    # We're inside the tetrahedron (3-Simplex) at (0,0,0)
+    def _low(self, xsb, ysb, zsb, xins, yins, zins, in_sum, dx0, dy0, dz0):
+        S = SQUISH_CONSTANT_3D
+        # Determine which two of (0,0,1), (0,1,0), (1,0,0) are closest.
+        a_score = xins
+        b_score = yins
+        swap_b = (a_score >= b_score) & (zins > b_score)
+        swap_a = ~swap_b & (a_score < b_score) & (zins > a_score)
+        a_point = np.where(swap_a, 0x04, 0x01)
+        a_score = np.where(swap_a, zins, a_score)
+        b_point = np.where(swap_b, 0x04, 0x02)
+        b_score = np.where(swap_b, zins, b_score)
+
+        # Determine the two lattice points not part of the tetrahedron that may contribute.
+        wins = 1 - in_sum
+        near = (wins > a_score) | (wins > b_score)
+
+        # (0,0,0) is one of the closest two tetrahedral vertices.
+        c = np.where(b_score > a_score, b_point, a_point)
+        cx = (c & 0x01) == 0
+        cy = (c & 0x02) == 0
+        cz = (c & 0x04) == 0
+        n_xsv0 = np.where(cx, xsb - 1, xsb + 1)
+        n_xsv1 = np.where(cx, xsb, xsb + 1)
+        n_dx0 = np.where(cx, dx0 + 1, dx0 - 1)
+        n_dx1 = np.where(cx, dx0, dx0 - 1)
+        n_ysv0 = np.where(cy, np.where(cx, ysb, ysb - 1), ysb + 1)
+        n_ysv1 = np.where(cy, np.where(cx, ysb - 1, ysb), ysb + 1)
+        n_dy0 = np.where(cy, np.where(cx, dy0, dy0 + 1), dy0 - 1)
+        n_dy1 = np.where(cy, np.where(cx, dy0 + 1, dy0), dy0 - 1)
+        n_zsv0 = np.where(cz, zsb, zsb + 1)
+        n_zsv1 = np.where(cz, zsb - 1, zsb + 1)
+        n_dz0 = np.where(cz, dz0, dz0 - 1)
+        n_dz1 = np.where(cz, dz0 + 1, dz0 - 1)
+
+        # (0,0,0) is not one of the closest two tetrahedral vertices.
+        c = a_point | b_point
+        cx = (c & 0x01) == 0
+        cy = (c & 0x02) == 0
+        cz = (c & 0x04) == 0
+        f_xsv0 = np.where(cx, xsb, xsb + 1)
+        f_xsv1 = np.where(cx, xsb - 1, xsb + 1)
+        f_dx0 = np.where(cx, dx0 - 2 * S, dx0 - 1 - 2 * S)
+        f_dx1 = np.where(cx, dx0 + 1 - S, dx0 - 1 - S)
+        f_ysv0 = np.where(cy, ysb, ysb + 1)
+        f_ysv1 = np.where(cy, ysb - 1, ysb + 1)
+        f_dy0 = np.where(cy, dy0 - 2 * S, dy0 - 1 - 2 * S)
+        f_dy1 = np.where(cy, dy0 + 1 - S, dy0 - 1 - S)
+        f_zsv0 = np.where(cz, zsb, zsb + 1)
+        f_zsv1 = np.where(cz, zsb - 1, zsb + 1)
+        f_dz0 = np.where(cz, dz0 - 2 * S, dz0 - 1 - 2 * S)
+        f_dz1 = np.where(cz, dz0 + 1 - S, dz0 - 1 - S)
+
+        ext0 = pick([near], [(n_xsv0, n_ysv0, n_zsv0, n_dx0, n_dy0, n_dz0),
+                             (f_xsv0, f_ysv0, f_zsv0, f_dx0, f_dy0, f_dz0)])
+        ext1 = pick([near], [(n_xsv1, n_ysv1, n_zsv1, n_dx1, n_dy1, n_dz1),
+                             (f_xsv1, f_ysv1, f_zsv1, f_dx1, f_dy1, f_dz1)])
+
+        value = np.zeros(xsb.shape)
+        # Contribution (0,0,0)
+        value = self._contribute(value, xsb, ysb, zsb, dx0, dy0, dz0)
+        # Contribution (1,0,0)
+        dx1 = dx0 - 1 - S
+        dy1 = dy0 - 0 - S
+        dz1 = dz0 - 0 - S
+        value = self._contribute(value, xsb + 1, ysb, zsb, dx1, dy1, dz1)
+        # Contribution (0,1,0)
+        dx2 = dx0 - 0 - S
+        dy2 = dy0 - 1 - S
+        dz2 = dz1
+        value = self._contribute(value, xsb, ysb + 1, zsb, dx2, dy2, dz2)
+        # Contribution (0,0,1)
+        dx3 = dx2
+        dy3 = dy1
+        dz3 = dz0 - 1 - S
+        value = self._contribute(value, xsb, ysb, zsb + 1, dx3, dy3, dz3)
+        # Extra vertices
+        value = self._contribute(value, *ext0)
+        return self._contribute(value, *ext1)
+
+    # We're inside the tetrahedron (3-Simplex) at (1,1,1)
+    def _high(self, xsb, ysb, zsb, xins, yins, zins, in_sum, dx0, dy0, dz0):
+        S = SQUISH_CONSTANT_3D
+        # Determine which two of (1,1,0), (1,0,1), (0,1,1) are closest.
+        a_score = xins
+        b_score = yins
+        swap_b = (a_score <= b_score) & (zins < b_score)
+        swap_a = ~swap_b & (a_score > b_score) & (zins < a_score)
+        a_point = np.where(swap_a, 0x03, 0x06)
+        a_score = np.where(swap_a, zins, a_score)
+        b_point = np.where(swap_b, 0x03, 0x05)
+        b_score = np.where(swap_b, zins, b_score)
+
+        # Determine the two lattice points not part of the tetrahedron that may contribute.
+        wins = 3 - in_sum
+        near = (wins < a_score) | (wins < b_score)
+
+        # (1,1,1) is one of the closest two tetrahedral vertices.
+        c = np.where(b_score < a_score, b_point, a_point)
+        cx = (c & 0x01) != 0
+        cy = (c & 0x02) != 0
+        cz = (c & 0x04) != 0
+        n_xsv0 = np.where(cx, xsb + 2, xsb)
+        n_xsv1 = np.where(cx, xsb + 1, xsb)
+        n_dx0 = np.where(cx, dx0 - 2 - 3 * S, dx0 - 3 * S)
+        n_dx1 = np.where(cx, dx0 - 1 - 3 * S, dx0 - 3 * S)
+        n_ysv0 = np.where(cy, np.where(cx, ysb + 1, ysb + 2), ysb)
+        n_ysv1 = np.where(cy, np.where(cx, ysb + 2, ysb + 1), ysb)
+        n_dy = dy0 - 1 - 3 * S
+        n_dy0 = np.where(cy, np.where(cx, n_dy, n_dy - 1), dy0 - 3 * S)
+        n_dy1 = np.where(cy, np.where(cx, n_dy - 1, n_dy), dy0 - 3 * S)
+        n_zsv0 = np.where(cz, zsb + 1, zsb)
+        n_zsv1 = np.where(cz, zsb + 2, zsb)
+        n_dz0 = np.where(cz, dz0 - 1 - 3 * S, dz0 - 3 * S)
+        n_dz1 = np.where(cz, dz0 - 2 - 3 * S, dz0 - 3 * S)
+
+        # (1,1,1) is not one of the closest two tetrahedral vertices.
+        c = a_point & b_point
+        cx = (c & 0x01) != 0
+        cy = (c & 0x02) != 0
+        cz = (c & 0x04) != 0
+        f_xsv0 = np.where(cx, xsb + 1, xsb)
+        f_xsv1 = np.where(cx, xsb + 2, xsb)
+        f_dx0 = np.where(cx, dx0 - 1 - S, dx0 - S)
+        f_dx1 = np.where(cx, dx0 - 2 - 2 * S, dx0 - 2 * S)
+        f_ysv0 = np.where(cy, ysb + 1, ysb)
+        f_ysv1 = np.where(cy, ysb + 2, ysb)
+        f_dy0 = np.where(cy, dy0 - 1 - S, dy0 - S)
+        f_dy1 = np.where(cy, dy0 - 2 - 2 * S, dy0 - 2 * S)
+        f_zsv0 = np.where(cz, zsb + 1, zsb)
+        f_zsv1 = np.where(cz, zsb + 2, zsb)
+        f_dz0 = np.where(cz, dz0 - 1 - S, dz0 - S)
+        f_dz1 = np.where(cz, dz0 - 2 - 2 * S, dz0 - 2 * S)
+
+        ext0 = pick([near], [(n_xsv0, n_ysv0, n_zsv0, n_dx0, n_dy0, n_dz0),
+                             (f_xsv0, f_ysv0, f_zsv0, f_dx0, f_dy0, f_dz0)])
+        ext1 = pick([near], [(n_xsv1, n_ysv1, n_zsv1, n_dx1, n_dy1, n_dz1),
+                             (f_xsv1, f_ysv1, f_zsv1, f_dx1, f_dy1, f_dz1)])
+
+        value = np.zeros(xsb.shape)
+        # Contribution (1,1,0)
+        dx3 = dx0 - 1 - 2 * S
+        dy3 = dy0 - 1 - 2 * S
+        dz3 = dz0 - 0 - 2 * S
+        value = self._contribute(value, xsb + 1, ysb + 1, zsb, dx3, dy3, dz3)
+        # Contribution (1,0,1)
+        dx2 = dx3
+        dy2 = dy0 - 0 - 2 * S
+        dz2 = dz0 - 1 - 2 * S
+        value = self._contribute(value, xsb + 1, ysb, zsb + 1, dx2, dy2, dz2)
+        # Contribution (0,1,1)
+        dx1 = dx0 - 0 - 2 * S
+        dy1 = dy3
+        dz1 = dz2
+        value = self._contribute(value, xsb, ysb + 1, zsb + 1, dx1, dy1, dz1)
+        # Contribution (1,1,1)
+        value = self._contribute(value, xsb + 1, ysb + 1, zsb + 1,
+                                 dx0 - 1 - 3 * S, dy0 - 1 - 3 * S, dz0 - 1 - 3 * S)
+        # Extra vertices
+        value = self._contribute(value, *ext0)
+        return self._contribute(value, *ext1)
+
+    # We're inside the octahedron (Rectified 3-Simplex) in between.
+    def _middle(self, xsb, ysb, zsb, xins, yins, zins, in_sum, dx0, dy0, dz0):
+        S = SQUISH_CONSTANT_3D
+        # Decide between point (0,0,1) and (1,1,0) as closest
+        p1 = xins + yins
+        a_further = p1 > 1
+        a_score = np.where(a_further, p1 - 1, 1 - p1)
+        a_point = np.where(a_further, 0x03, 0x04)
+
+        # Decide between point (0,1,0) and (1,0,1) as closest
+        p2 = xins + zins
+        b_further = p2 > 1
+        b_score = np.where(b_further, p2 - 1, 1 - p2)
+        b_point = np.where(b_further, 0x05, 0x02)
+
+        # The closest out of (1,0,0) and (0,1,1) will replace the furthest of the two
+        # decided above, if closer.
+        p3 = yins + zins
+        further = p3 > 1
+        score = np.where(further, p3 - 1, 1 - p3)
+        point = np.where(further, 0x06, 0x01)
+        replace_a = (a_score <= b_score) & (a_score < score)
+        replace_b = ~replace_a & (a_score > b_score) & (b_score < score)
+        a_point = np.where(replace_a, point, a_point)
+        a_further = np.where(replace_a, further, a_further)
+        b_point = np.where(replace_b, point, b_point)
+        b_further = np.where(replace_b, further, b_further)
+
+        # candidate extra vertices
+        v111 = (xsb + 1, ysb + 1, zsb + 1, dx0 - 1 - 3 * S, dy0 - 1 - 3 * S, dz0 - 1 - 3 * S)
+        v000 = (xsb, ysb, zsb, dx0, dy0, dz0)
+        v200 = (xsb + 2, ysb, zsb, dx0 - 2 - 2 * S, dy0 - 2 * S, dz0 - 2 * S)
+        v020 = (xsb, ysb + 2, zsb, dx0 - 2 * S, dy0 - 2 - 2 * S, dz0 - 2 * S)
+        v002 = (xsb, ysb, zsb + 2, dx0 - 2 * S, dy0 - 2 * S, dz0 - 2 - 2 * S)
+        vm11 = (xsb - 1, ysb + 1, zsb + 1, dx0 + 1 - S, dy0 - 1 - S, dz0 - 1 - S)
+        v1m1 = (xsb + 1, ysb - 1, zsb + 1, dx0 - 1 - S, dy0 + 1 - S, dz0 - 1 - S)
+        v11m = (xsb + 1, ysb + 1, zsb - 1, dx0 - 1 - S, dy0 - 1 - S, dz0 + 1 - S)
+        # permutations of (0,0,2) reached by stepping from (-2/3,-2/3,-2/3)
+        w200 = (xsb + 2, ysb, zsb, dx0 - 2 * S - 2, dy0 - 2 * S, dz0 - 2 * S)
+        w020 = (xsb, ysb + 2, zsb, dx0 - 2 * S, dy0 - 2 * S - 2, dz0 - 2 * S)
+        w002 = (xsb, ysb, zsb + 2, dx0 - 2 * S, dy0 - 2 * S, dz0 - 2 * S - 2)
+
+        same = a_further == b_further
+        both_further = same & a_further
+        both_nearer = same & ~a_further
+
+        # Both closest points on (1,1,1) side: (1,1,1) plus a point based on the shared axis.
+        c = a_point & b_point
+        s_ext1 = pick([(c & 0x01) != 0, (c & 0x02) != 0], [v200, v020, v002])
+        # Both closest points on (0,0,0) side: (0,0,0) plus a point based on the omitted axis.
+        c = a_point | b_point
+        o_ext1 = pick([(c & 0x01) == 0, (c & 0x02) == 0], [vm11, v1m1, v11m])
+        # One point on each side: a permutation of (1,1,-1) and one of (0,0,2)
+        c1 = np.where(a_further, a_point, b_point)
+        c2 = np.where(a_further, b_point, a_point)
+        m_ext0 = pick([(c1 & 0x01) == 0, (c1 & 0x02) == 0], [vm11, v1m1, v11m])
+        m_ext1 = pick([(c2 & 0x01) != 0, (c2 & 0x02) != 0], [w200, w020, w002])
+
+        ext0 = pick([both_further, both_nearer], [v111, v000, m_ext0])
+        ext1 = pick([both_further, both_nearer], [s_ext1, o_ext1, m_ext1])
+
+        value = np.zeros(xsb.shape)
+        # Contribution (1,0,0)
+        dx1 = dx0 - 1 - S
+        dy1 = dy0 - 0 - S
+        dz1 = dz0 - 0 - S
+        value = self._contribute(value, xsb + 1, ysb, zsb, dx1, dy1, dz1)
+        # Contribution (0,1,0)
+        dx2 = dx0 - 0 - S
+        dy2 = dy0 - 1 - S
+        dz2 = dz1
+        value = self._contribute(value, xsb, ysb + 1, zsb, dx2, dy2, dz2)
+        # Contribution (0,0,1)
+        dx3 = dx2
+        dy3 = dy1
+        dz3 = dz0 - 1 - S
+        value = self._contribute(value, xsb, ysb, zsb + 1, dx3, dy3, dz3)
+        # Contribution (1,1,0)
+        dx4 = dx0 - 1 - 2 * S
+        dy4 = dy0 - 1 - 2 * S
+        dz4 = dz0 - 0 - 2 * S
+        value = self._contribute(value, xsb + 1, ysb + 1, zsb, dx4, dy4, dz4)
+        # Contribution (1,0,1)
+        dx5 = dx4
+        dy5 = dy0 - 0 - 2 * S
+        dz5 = dz0 - 1 - 2 * S
+        value = self._contribute(value, xsb + 1, ysb, zsb + 1, dx5, dy5, dz5)
+        # Contribution (0,1,1)
+        dx6 = dx0 - 0 - 2 * S
+        dy6 = dy4
+        dz6 = dz5
+        value = self._contribute(value, xsb, ysb + 1, zsb + 1, dx6, dy6, dz6)
+        # Extra vertices
+        value = self._contribute(value, *ext0)
+        return self._contribute(value, *ext1)
@@ -2,12 +2,18 @@
 Randomly generates a starscape.
 '''
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
 import numpy as np
 import os
-import random
 import sys
 
+import instrument as inst
+import pipeline as pl
 import process as proc
+import shard
 import utility as util
 import formula as f
 
@@ -15,6 +21,16 @@ import formula as f
 img_size = (32, 1024, 1024)
 feature_size = (64.0, 128.0, 128.0)
 chunk_size = (32, 32, 32)
+# storage type of the cached probability map, and whether to memory-map it
+cache_dtype = np.float32
+cache_mmap = True
+# default directory of the persistent noise chunk store, or None to not keep chunks
+chunk_store = None
+
+# default parameters of a run
+defaults = {"seed": None, "cache": None, "reduction": 2, "cutoff": 0.7, "universe": 13.8, "count": 15000}
+# default settings of a batch run, which apply to every combination
+run_defaults = {"output": os.path.join(os.path.curdir, 'output'), "workers": 1, "chunk_store": None, "hr_mode": "auto"}
 
 def seed():
     # get seed value from user
@@ -22,83 +38,261 @@ def seed():
     # default case
     if s == '':
         s = np.random.randint(2**32 - 1)
-        print("Using seed", s)
+        inst.message("Using seed {:d}".format(s), seed=s)
     else:
         s = int(s)
-    # generate a random seed for the rest of computation
-    random.seed(s)
-    np.random.seed(s)
     return s
 
-def prob(s):
-    # calculate a new probability map if the user requests it
-    p = np.array([])
-    path = input("Enter file path to raw probability file (default: {:s}): ".format(os.path.join(os.path.curdir, 'output', 'prob.raw')))
-    # default case
-    if path == '':
-        path = os.path.join(os.path.curdir, 'output', 'prob.raw')
+# default path of the probability cache file for a seed
+def cache_path(s):
+    params = util.prob_cache_params(s, img_size, proc.feature_size, proc.chunk_size, cache_dtype)
+    return os.path.join(os.path.curdir, 'output', 'prob_{:s}.cache'.format(util.cache_key(params)))
+
+# load the probability map for a seed from the cache file at path, generating it if
+# the file does not exist or does not match our parameters. Noise chunks are kept in and
+# reused from the chunk store in the directory store_dir, by default chunk_store.
+def load_prob(s, path=None, executor="process", store_dir=None):
+    if store_dir is None:
+        store_dir = chunk_store
+    params = util.prob_cache_params(s, img_size, proc.feature_size, proc.chunk_size, cache_dtype)
+    if path is None:
+        path = cache_path(s)
     # attempt to load file
-    try:
-        p = np.fromfile(path)
-        p = np.reshape(p, img_size)
-        print("Using existing file")
-    # if file does not exist, generate a new starscape
-    except OSError:
-        print("File not found. Generating a new starscape.")
-        p = proc.probability_map(s, img_size)
-        p.tofile(path)
-
-    # get stringing value from user
-    str = input("Enter a probability reduction value (default: 2): ")
-    # default case
-    if str == '':
-        str = 2
-    else:
-        str = int(str)
-
-    # modify probability map by the requested power
-    p = np.power(p, str)
-    util.write_dist_img(p, img_size, os.path.join(os.path.curdir, 'output', 'distribution'))
-    return p
-
-def cluster(prob):
-    # get clustering amout
-    clusval = input("Enter cluster cutoff, in the range 0-1 (default: 0.7): ")
-    if clusval == '':
-        clusval = 0.7
-    else:
-        clusval = float(clusval)
+    p = util.read_prob_cache(path, params, mmap=cache_mmap)
+    if p is not None:
+        inst.message("Using existing file", path=path)
+        return p
+    inst.message("No matching cache file found. Generating a new starscape.", path=path)
+    # generate into a temporary raw file so the full volume never sits in memory
+    store = None
+    if store_dir is not None:
+        store = util.ChunkStore(store_dir, s, proc.feature_size, proc.chunk_size)
+    p = proc.probability_map(s, img_size, executor=executor, path=path+".tmp", store=store)
+    util.write_prob_cache(path, params, p)
+    del p
+    os.remove(path+".tmp")
+    return util.read_prob_cache(path, params, mmap=cache_mmap)
 
-    a = input("Enter the age of the universe, in billions of years (default: 13.8): ")
-    if a == '':
-        a = 13.8
-    else:
-        a = int(a)
+# directory of the stage result cache, or None to keep results in memory only
+stage_cache = os.path.join(os.path.curdir, 'output', 'stages')
+# number of images written at once
+render_workers = 4
+
+# save and load the clusters stage, the labels and the ages of the clusters
+def save_clusters(path, result):
+    clusters, ages = result
+    clusters.save(path+".tmp.npz", ages=ages)
+    os.replace(path+".tmp.npz", path+".npz")
+
+def load_clusters(path):
+    loaded = proc.ClusterMap.load(path+".npz")
+    if loaded is None:
+        return None
+    clusters, extra = loaded
+    return clusters, extra["ages"]
+
+# Load the catalog stages. They are streamed to their cache files as they are made, and
+# memory-mapped back, so catalogs larger than memory can be generated and rendered.
+def load_catalog(path):
+    return proc.Catalog.load(path+".npy", mmap=True)
+
+# generate the catalog, streaming it to the record file at path if one is given
+def stream_stars(p, clusters, count, seed, path=None):
+    if path is None:
+        return proc.generate_stars(p, clusters[0], count, img_size, seed)
+    stars = proc.generate_stars(p, clusters[0], count, img_size, seed, path+".tmp.npy")
+    os.replace(path+".tmp.npy", path+".npy")
+    return stars
+
+# age a copy of the catalog, so the unaged catalog stays valid for other stages. The
+# copy is streamed to the record file at path if one is given.
+def stream_aged(stars, clusters, universe, seed, path=None):
+    if path is None:
+        return proc.age_stars(proc.Catalog(stars.data.copy()), clusters[1], universe, seed)
+    aged = proc.age_stars(stars, clusters[1], universe, seed, path+".tmp.npy")
+    os.replace(path+".tmp.npy", path+".npy")
+    return aged
 
-    # determine cluster locations
-    clusters, ages = proc.find_clusters(prob, clusval, a, img_size)
-    util.write_cluster_image(clusters, img_size, os.path.join(os.path.curdir, 'output', 'clusters'))
-    return clusters, ages, a
+# Build the stages of one run, writing the distribution, cluster and star images into
+# the three directories of dirs. Returns the nodes that write the images.
+# probability map -> reduced map -> clusters -> catalog -> aged catalog
+#                     `-> distribution   `-> cluster image     `-> HR diagram, star images, catalog
+def build(params, dirs, executor="process", store_dir=None, hr_mode="auto"):
+    s = params["seed"]
+    noise = util.prob_cache_params(s, img_size, proc.feature_size, proc.chunk_size, cache_dtype)
+    prob = pl.Node("prob", lambda: load_prob(s, params["cache"], executor, store_dir), params=noise)
+    reduced = pl.Node("reduced", lambda p: np.power(p, params["reduction"]), [prob],
+                      {"reduction": params["reduction"]})
+    clusters = pl.Node("clusters", lambda p, seq: proc.find_clusters(p, params["cutoff"], params["universe"],
+                                                                     img_size, seed=seq),
+                       [reduced], {"cutoff": params["cutoff"], "universe": params["universe"]},
+                       save=save_clusters, load=load_clusters, random=True)
+    stars = pl.Node("stars", lambda p, c, seq, path: stream_stars(p, c, params["count"], seq, path),
+                    [reduced, clusters], {"count": params["count"]}, load=load_catalog, random=True, stream=True)
+    aged = pl.Node("aged", lambda st, c, seq, path: stream_aged(st, c, params["universe"], seq, path),
+                   [stars, clusters], {"universe": params["universe"]}, load=load_catalog, random=True, stream=True)
+    # renderers
+    dist = os.path.join(dirs[0], 'distribution')
+    cimg = os.path.join(dirs[1], 'clusters')
+    sdir = dirs[2]
+    shots = exposures(sdir)
+    return [
+        pl.Node("distribution", lambda p: util.write_dist_img(p, img_size, dist), [reduced], output=dist),
+        pl.Node("cluster_image", lambda c, seq: util.write_cluster_image(c[0], img_size, cimg, seed=seq), [clusters],
+                output=cimg, random=True),
+        pl.Node("HR", lambda st: util.write_HR_diagram(st, os.path.join(sdir, 'HR'), hr_mode), [aged], output=sdir),
+        pl.Node("catalog", lambda st: st.save(os.path.join(sdir, 'catalog.npy')), [aged], output=sdir),
+        pl.Node("star_images", lambda st: util.write_star_images(st, img_size, shots), [aged], output=sdir),
+    ]
 
-def star(prob, clusters):
-    count = input("Enter the number of stars to generate (default: 15000): ")
-    if count == '':
-        count = 15000
+# the star images of a run, as (name, distance) exposures written into sdir
+def exposures(sdir):
+    return [(os.path.join(sdir, 'stars_eye'), 5), (os.path.join(sdir, 'stars_hubble'), 1000)]
+
+# Seed of each random stage of a run, as the integer its seed sequence is made from.
+# These are the seeds the pipeline gives the stages, so a sharded run draws the same
+# numbers.
+def stage_seeds(params):
+    seeds = {}
+    todo = build(params, ("", "", ""))
+    while todo:
+        n = todo.pop()
+        if n.random:
+            seeds[n.name] = int(n.key, 16)
+        todo += n.deps
+    return seeds
+
+# Generate one combination in slabs on a shard backend (see shard.run), writing the
+# same files as the pipeline. Intermediate results are not cached.
+def run_sharded(c, dirs, backend, shards, store_dir=None, hr_mode="auto"):
+    shard.run(c, dirs, backend, stage_seeds(c), img_size, exposures(dirs[2]), shards,
+              store_dir=store_dir if store_dir is not None else chunk_store, hr_mode=hr_mode)
+
+# Expand a configuration, where any parameter may be a list of values, into every
+# combination of parameters. Missing parameters take their default values.
+def combinations(config):
+    values = []
+    for k in defaults:
+        v = config.get(k, defaults[k])
+        values.append(v if isinstance(v, list) else [v])
+    return [dict(zip(defaults, c)) for c in itertools.product(*values)]
+
+# Run every combination that shares a seed. The stages of all combinations go into one
+# pipeline, so each intermediate result is computed once: one probability map per
+# seed, one distribution per reduction value, one set of clusters per cutoff and
+# universe age, and so on. Each stage is seeded from its own parameters, so every
+# combination gives the same result as running it on its own.
+# With nested set, each level of sharing gets its own output directory.
+def run_seed(s, combos, output, nested=True, executor="process", store_dir=None, hr_mode="auto"):
+    pipe = pl.Pipeline(stage_cache)
+    renders = []
+    for c in combos:
+        renders += build(c, run_dirs(c, output, nested), executor, store_dir, hr_mode)
+    pipe.run(renders, render_workers)
+
+# Output directories of the distribution, cluster and star images of a combination,
+# created if needed. With nested set, each level of sharing gets its own directory.
+def run_dirs(c, output, nested):
+    rdir = os.path.join(output, "seed_{:d}".format(c["seed"]), "reduction_{}".format(c["reduction"])) if nested else output
+    cdir = os.path.join(rdir, "cutoff_{}_universe_{}".format(c["cutoff"], c["universe"])) if nested else rdir
+    sdir = os.path.join(cdir, "count_{:d}".format(c["count"])) if nested else cdir
+    os.makedirs(sdir, exist_ok=True)
+    return rdir, cdir, sdir
+
+# Run every combination of a configuration. Seeds are run in parallel on up to
+# workers processes, each computing its own intermediate results once. With a shard
+# backend, each combination is instead generated in turn, split into shards slabs.
+def sweep(config, output, workers=1, backend=None, shards=1, store_dir=None, hr_mode="auto"):
+    # a missing seed is drawn once, so every combination shares its probability map
+    config = dict(config)
+    if config.get("seed") is None:
+        config["seed"] = int(np.random.randint(2**32 - 1))
+        inst.message("Using seed {:d}".format(config["seed"]), seed=config["seed"])
+    combos = combinations(config)
+    seeds = list(dict.fromkeys(c["seed"] for c in combos))
+    if len(seeds) > 1 and any(c["cache"] is not None for c in combos):
+        raise ValueError("a cache file can only be given for a single seed")
+    nested = len(combos) > 1
+    groups = [[c for c in combos if c["seed"] == s] for s in seeds]
+    if backend is not None:
+        for c in combos:
+            run_sharded(c, run_dirs(c, output, nested), backend, shards, store_dir, hr_mode)
+    elif workers > 1 and len(seeds) > 1:
+        # seeds already run in parallel, so generate each map on threads
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(run_seed, s, g, output, nested, "thread", store_dir, hr_mode) for s, g in zip(seeds, groups)]
+            for j in jobs:
+                j.result()
     else:
-        count = int(count)
+        for s, g in zip(seeds, groups):
+            run_seed(s, g, output, nested, store_dir=store_dir, hr_mode=hr_mode)
 
-    # generate stars in space
-    return proc.generate_stars(prob, clusters, count, img_size)
+# command line interface. Without arguments, parameters are asked for interactively.
+parser = argparse.ArgumentParser(description="Randomly generates a starscape.")
+parser.add_argument("--config", help="JSON file of parameters; any parameter may be a list of values")
+parser.add_argument("--seed", type=int, nargs="+", help="integer seed(s) (default: random)")
+parser.add_argument("--cache", help="probability cache file, for a single seed (default: output/prob_<hash>.cache)")
+parser.add_argument("--reduction", type=int, nargs="+", help="probability reduction value(s) (default: 2)")
+parser.add_argument("--cutoff", type=float, nargs="+", help="cluster cutoff(s), in the range 0-1 (default: 0.7)")
+parser.add_argument("--universe", type=float, nargs="+", help="age(s) of the universe, in billions of years (default: 13.8)")
+parser.add_argument("--count", type=int, nargs="+", help="number(s) of stars to generate (default: 15000)")
+parser.add_argument("--output", help="output directory (default: ./output)")
+parser.add_argument("--workers", type=int, help="number of seeds to run in parallel (default: 1)")
+parser.add_argument("--chunk-store", dest="chunk_store",
+                    help="directory to keep noise chunks in, so later runs only compute chunks they have not seen")
+parser.add_argument("--hr-mode", dest="hr_mode", choices=["scatter", "density", "auto"],
+                    help="how HR diagrams are drawn: every star, binned, or binned only for large catalogs (default: auto)")
+parser.add_argument("--shards", type=int, help="split the volume into this many slabs, generated as separate tasks")
+parser.add_argument("--backend", choices=["local", "queue"], default="local",
+                    help="where shard tasks run: local processes, or a work queue directory (default: local)")
+parser.add_argument("--queue", default=os.path.join(os.path.curdir, 'output', 'queue'),
+                    help="work queue directory of the queue backend (default: ./output/queue)")
+parser.add_argument("--quiet", action="store_true", help="do not print progress")
+parser.add_argument("--log", help="also write progress and timings to this file, as JSON lines")
 
+def main(argv):
+    args = parser.parse_args(argv)
+    sinks = [] if args.quiet else [inst.Console()]
+    if args.log is not None:
+        sinks.append(inst.JSONLines(args.log))
+    inst.sink = inst.Tee(*sinks) if sinks else None
+    config = {}
+    if args.config is not None:
+        with open(args.config) as fh:
+            config = json.load(fh)
+    # command line flags override the configuration file
+    for k in list(defaults) + list(run_defaults):
+        v = getattr(args, k)
+        if v is not None:
+            config[k] = v
+    settings = {k: config.pop(k, v) for k, v in run_defaults.items()}
+    backend = None
+    if args.shards is not None:
+        backend = shard.LocalBackend(args.shards) if args.backend == "local" else shard.QueueBackend(args.queue)
+    sweep(config, settings["output"], settings["workers"], backend, args.shards, settings["chunk_store"],
+          settings["hr_mode"])
 
-if __name__ == '__main__':
+# ask for a value, converting it with type, or use default if nothing is entered
+def ask(prompt, default, type):
+    v = input(prompt)
+    if v == '':
+        return default
+    return type(v)
+
+def interactive():
     s = seed()
-    p = prob(s)
-    c, a, max_age = cluster(p)
-    stars = star(p, c)
-    stars = proc.age_stars(stars, a, max_age)
-
-    # draw images and generate a HR diagram
-    util.write_HR_diagram(stars, os.path.join(os.path.curdir, 'output', 'HR'))
-    util.write_star_image(stars, img_size, os.path.join(os.path.curdir, 'output', 'stars_eye'), distance=5)
-    util.write_star_image(stars, img_size, os.path.join(os.path.curdir, 'output', 'stars_hubble'), distance=1000)
+    # calculate a new probability map unless a matching cache file exists
+    path = ask("Enter file path to probability cache file (default: {:s}): ".format(cache_path(s)), cache_path(s), str)
+    params = {"seed": s, "cache": path,
+              "reduction": ask("Enter a probability reduction value (default: 2): ", 2, int),
+              "cutoff": ask("Enter cluster cutoff, in the range 0-1 (default: 0.7): ", 0.7, float),
+              "universe": ask("Enter the age of the universe, in billions of years (default: 13.8): ", 13.8, float),
+              "count": ask("Enter the number of stars to generate (default: 15000): ", 15000, int)}
+    run_seed(s, [params], os.path.join(os.path.curdir, 'output'), nested=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        interactive()
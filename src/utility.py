@@ -2,119 +2,439 @@
 Utility. Reading/Writing data, taking user input, etc. No astronomical processing
 happens here.
 '''
+import hashlib
+import json
+import os
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 
 import formula as f
+import instrument as inst
 
-# Write distribution map to image. Expects 3D numpy space
-def write_dist_img(data, img_size, name):
-    print("Writing {:s}.png to disk... ".format(name), end="", flush=True)
-    # normalize data to range [0-1]
-    data = (data - np.amin(data))/np.ptp(data)
-    # copy data to image array
-    img = np.zeros(img_size[1:])
-    for i in range(data.shape[0]):
-        img += f.inv_sq(data[i], i, 2)
-    # normalize image to range [0-255]
-    img = ((img - np.amin(img))/np.ptp(img)*255).astype(int)
-    plt.imsave(name+".png", img, cmap="gray")
-    print("Done")
-
-# Write clusters to image. Expects 3D numpy space of integers
-def write_cluster_image(data, img_size, name):
-    print("Writing {:s}.png to disk... ".format(name), end="", flush=True)
-    # generate random colors for each cluster
-    colors = np.random.randint(32, 255, (np.amax(data),3)).astype(np.uint8)
-    # copy data to image array
-    img = np.zeros((img_size[1], img_size[2], 3)).astype(np.uint8)
-    for i in range(data.shape[0]):
-        # get free pixels that are in clusters
-        pixels = data[i] > 0
-        # set pixel color according to the cluster-color map
-        img[pixels] = colors[data[i][pixels]-1]
-    # write image to disk
-    plt.imsave(name+".png", img)
-    print("Done")
+# Probability map cache. Cache files start with a fixed-size JSON header recording the
+# parameters that produced the map, followed by the raw voxel data in C order.
+cache_header_size = 4096
+cache_version = 1
+
+# parameters identifying a probability map
+def prob_cache_params(seed, img_size, feature_size, chunk_size, dtype=np.float32):
+    return {"version": cache_version,
+            "seed": int(seed),
+            "img_size": [int(i) for i in img_size],
+            "feature_size": [float(i) for i in feature_size],
+            "chunk_size": [int(i) for i in chunk_size],
+            "dtype": np.dtype(dtype).name}
+
+# short content hash of a set of parameters, used to name cache files
+def cache_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+# Random streams. Each random stage draws from its own seed sequence, and each part of a
+# stage (a plane, a chunk) from a substream of it. A substream is named by a path of
+# integers rather than spawned in order, so any part can be recreated on its own and
+# parts can run in any order, in parallel, or in separate processes.
+# seed may be an integer, a SeedSequence, or None for fresh entropy.
+def seed_sequence(seed=None):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+# generator for the part of a seed sequence named by path
+def substream(seq, *path):
+    return np.random.default_rng(np.random.SeedSequence(seq.entropy, spawn_key=tuple(seq.spawn_key) + path))
+
+# Read a cached probability map. Returns None if the file does not exist, was
+# generated with different parameters, or does not hold the whole map. With mmap the
+# data stays on disk.
+def read_prob_cache(path, params, mmap=True):
+    try:
+        with open(path, "rb") as fh:
+            header = json.loads(fh.read(cache_header_size).decode().rstrip())
+        size = os.path.getsize(path)
+    except (OSError, ValueError):
+        return None
+    if header != params:
+        return None
+    shape = tuple(params["img_size"])
+    if size != cache_header_size + int(np.prod(shape)) * np.dtype(params["dtype"]).itemsize:
+        return None
+    if mmap:
+        return np.memmap(path, dtype=params["dtype"], mode="r", offset=cache_header_size, shape=shape)
+    return np.fromfile(path, dtype=params["dtype"], offset=cache_header_size).reshape(shape)
+
+# Write a probability map to a cache file, converting one plane at a time so no
+# full-volume copy is made. Written under a temporary name first, so an interrupted
+# run never leaves a partial cache behind.
+def write_prob_cache(path, params, data):
+    header = json.dumps(params).encode()
+    tmp = path + ".part"
+    with open(tmp, "wb") as fh:
+        fh.write(header.ljust(cache_header_size))
+        for plane in data:
+            plane.astype(params["dtype"]).tofile(fh)
+    os.replace(tmp, path)
+
+# Persistent store of raw noise chunks. Chunks are pure functions of their chunk
+# coordinates and the generation parameters, so each one is computed at most once and
+# reused when the volume grows or a sub-region is requested. Each set of parameters
+# gets its own directory, with one .npy file per chunk.
+class ChunkStore:
+    def __init__(self, root, seed, feature_size, chunk_size):
+        params = {"version": cache_version,
+                  "seed": int(seed),
+                  "feature_size": [float(i) for i in feature_size],
+                  "chunk_size": [int(i) for i in chunk_size]}
+        self.path = os.path.join(root, "chunks_" + cache_key(params))
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "params.json"), "w") as fh:
+            json.dump(params, fh)
+    def _file(self, c):
+        return os.path.join(self.path, "{:d}_{:d}_{:d}.npy".format(*c))
+    # check whether a chunk has been computed
+    def has(self, c):
+        return os.path.exists(self._file(c))
+    # load a computed chunk
+    def get(self, c, mmap=False):
+        return np.load(self._file(c), mmap_mode="r" if mmap else None)
+    # save a chunk. Written under a temporary name first, so an interrupted run never
+    # leaves a partial chunk behind.
+    def put(self, c, chunk):
+        tmp = self._file(c) + ".tmp"
+        with open(tmp, "wb") as fh:
+            np.save(fh, chunk)
+        os.replace(tmp, self._file(c))
+
+# Tiled output for images too large to hold in memory. The image is produced one tile
+# at a time and each tile is streamed to disk, either into a memory-mapped .npy file
+# ("npy") or as a directory of PNG files named by tile row and column ("png").
+class TileWriter:
+    def __init__(self, name, shape, tile, mosaic="npy", cmap=None):
+        self.shape = tuple(shape)
+        self.tile = tile
+        self.mosaic = mosaic
+        self.cmap = cmap
+        if mosaic == "npy":
+            self.path = name+".npy"
+            self.img = np.lib.format.open_memmap(self.path, mode="w+", dtype=np.uint8, shape=self.shape)
+        else:
+            self.path = name
+            os.makedirs(self.path, exist_ok=True)
+    # bounds (y0, y1, z0, z1) of every tile
+    def tiles(self):
+        return tile_bounds(self.shape, self.tile)
+    # store the tile whose top-left pixel is (y0, z0)
+    def write(self, y0, z0, img):
+        if self.mosaic == "npy":
+            self.img[y0:y0+img.shape[0], z0:z0+img.shape[1]] = img
+        else:
+            tile = os.path.join(self.path, "{:d}_{:d}.png".format(y0 // self.tile, z0 // self.tile))
+            plt.imsave(tile, img, cmap=self.cmap, vmin=0, vmax=255)
+    def close(self):
+        if self.mosaic == "npy":
+            self.img.flush()
+            del self.img
+
+# bounds (y0, y1, z0, z1) of every tile of an image
+def tile_bounds(shape, tile):
+    for y0 in range(0, shape[0], tile):
+        for z0 in range(0, shape[1], tile):
+            yield y0, min(y0+tile, shape[0]), z0, min(z0+tile, shape[1])
+
+# Nearest-neighbour upscale of the source pixels covering output rows y0:y1 and columns
+# z0:z1. get(ys, ye, zs, ze) returns the source block ys:ye, zs:ze.
+def upscale(get, y0, y1, z0, z1, scale):
+    ys, zs = y0 // scale, z0 // scale
+    block = get(ys, -(-y1 // scale), zs, -(-z1 // scale))
+    return block[np.arange(y0, y1) // scale - ys][:, np.arange(z0, z1) // scale - zs]
+
+# depth weight of each x plane of a volume: the inverse square law, with the nearest
+# plane off units away
+def depth_weights(depth, off=2):
+    return f.inv_sq(1.0, np.arange(depth), off)
+
+# rows of the image projected at once by project_depth
+projection_rows = 64
+
+# Project a volume along the x axis as a weighted sum of its planes, over the source
+# pixels ys:ye, zs:ze. Each block of block_rows rows is reduced in one tensordot, so a
+# memory-mapped volume is read block by block and no full-volume temporary is made.
+def project_depth(data, weights, ys, ye, zs, ze, block_rows=projection_rows):
+    img = np.empty((ye-ys, ze-zs))
+    for y in range(ys, ye, block_rows):
+        y1 = min(y+block_rows, ye)
+        img[y-ys:y1-ys] = np.tensordot(weights, data[:, y:y1, zs:ze], axes=(0, 0))
+    return img
+
+# depth-weighted projection of the distribution over the source pixels ys:ye, zs:ze
+def project_dist(data, ys, ye, zs, ze):
+    return project_depth(data, depth_weights(data.shape[0]), ys, ye, zs, ze)
+
+# write every tile of out from the source pixels given by get, scaled up by scale
+def write_tiles(out, get, scale, span=inst.null_span):
+    tiles = list(out.tiles())
+    for i, (y0, y1, z0, z1) in enumerate(tiles):
+        out.write(y0, z0, upscale(get, y0, y1, z0, z1, scale))
+        span.count("tiles")
+        span.progress(i + 1, len(tiles))
+    out.close()
+
+# Write distribution map to image. Expects 3D numpy space. If tile is given, the image
+# is scaled up by scale and written tile by tile as a mosaic (see TileWriter).
+def write_dist_img(data, img_size, name, tile=None, scale=1, mosaic="npy"):
+    if tile is None:
+        save_dist_img(project_dist(data, 0, img_size[1], 0, img_size[2]), img_size, name, scale)
+        return
+    with inst.span("write_dist_img", "Writing {:s} mosaic to disk".format(name)) as span:
+        # Project in the same row blocks as the untiled path, so the sums round the same
+        # way and the mosaic matches its image. Find the image range in a first pass, then
+        # keep the normalized source image as bytes for the tiles to be scaled up from.
+        rows = [(y, min(y+projection_rows, img_size[1])) for y in range(0, img_size[1], projection_rows)]
+        lo, hi = np.inf, -np.inf
+        for ys, ye in rows:
+            img = project_dist(data, ys, ye, 0, img_size[2])
+            lo, hi = min(lo, np.amin(img)), max(hi, np.amax(img))
+        src = np.empty(img_size[1:], dtype=np.uint8)
+        for ys, ye in rows:
+            src[ys:ye] = ((project_dist(data, ys, ye, 0, img_size[2]) - lo)/(hi - lo)*255).astype(np.uint8)
+        out = TileWriter(name, (img_size[1]*scale, img_size[2]*scale), tile, mosaic, cmap="gray")
+        write_tiles(out, lambda ys, ye, zs, ze: src[ys:ye, zs:ze], scale, span)
+
+# Write an already projected distribution to name.png, normalized and scaled up by scale
+def save_dist_img(img, img_size, name, scale=1):
+    with inst.span("write_dist_img", "Writing {:s}.png to disk".format(name)):
+        # normalize image to range [0-255]
+        img = ((img - np.amin(img))/np.ptp(img)*255).astype(int)
+        img = upscale(lambda ys, ye, zs, ze: img[ys:ye, zs:ze], 0, img_size[1]*scale, 0, img_size[2]*scale, scale)
+        plt.imsave(name+".png", img, cmap="gray")
+
+# Write clusters to image. Expects a ClusterMap. If tile is given, the image is scaled
+# up by scale and written tile by tile as a mosaic (see TileWriter). The cluster colors
+# are drawn from seed.
+def write_cluster_image(data, img_size, name, tile=None, scale=1, mosaic="npy", seed=None):
+    # project the clusters onto the image plane, furthest cluster on top
+    write_cluster_labels(data.project(), data.count, img_size, name, tile, scale, mosaic, seed)
+
+# Write projected cluster labels, out of count clusters, to image, as write_cluster_image
+def write_cluster_labels(labels, count, img_size, name, tile=None, scale=1, mosaic="npy", seed=None):
+    # generate random colors for each cluster, with black for no cluster
+    colors = np.zeros((count+1, 3), dtype=np.uint8)
+    colors[1:] = np.random.default_rng(seed).integers(32, 255, (count,3))
+    get = lambda ys, ye, zs, ze: colors[labels[ys:ye, zs:ze].astype(np.intp)]
+    if tile is None:
+        with inst.span("write_cluster_image", "Writing {:s}.png to disk".format(name)):
+            img = upscale(get, 0, img_size[1]*scale, 0, img_size[2]*scale, scale)
+            # write image to disk
+            plt.imsave(name+".png", img)
+        return
+    with inst.span("write_cluster_image", "Writing {:s} mosaic to disk".format(name)) as span:
+        out = TileWriter(name, (img_size[1]*scale, img_size[2]*scale, 3), tile, mosaic)
+        write_tiles(out, get, scale, span)
+
+# Image "luminosity" of each spectral class, in the range 0-9. If we use the realistic
+# luminosity for a star when generating an image, we will only be able to see the
+# O-type stars.
+img_lums = np.array(["-MK--GFABO".index(c) for c in f.spectral_classes])
+
+# Point-spread kernels used to draw each star. Each kernel is centered on the star and
+# scales the star's color.
+kernels = {
+    "point": np.array([[1.0]]),
+    "cross": np.array([[0, 1, 0],
+                       [1, 1, 1],
+                       [0, 1, 0]], dtype=float),
+    "gaussian": np.exp(-0.5 * np.add.outer(np.arange(-2, 3)**2, np.arange(-2, 3)**2) / 0.8**2),
+}
+
+# colors of all stars for each exposure distance, scaled by their distance modifiers
+def star_values(stars, distances, ranges=None):
+    if ranges is None:
+        ranges = mod_ranges(stars, distances)
+    lums = img_lums[stars["type"]]
+    colors = f.palette[stars["color"]].astype(np.float64)
+    vals = []
+    for distance, (lo, hi) in zip(distances, ranges):
+        # calculate distance modifiers, normalized to range 0-1
+        mods = f.inv_sq(lums, stars["x"], distance)
+        mods = (mods - lo)/(hi - lo)
+        vals.append(colors * mods[:, None])
+    return vals
+
+# the stars of a catalog or star array, as consecutive arrays of at most size stars
+def star_blocks(stars, size=2**20):
+    data = getattr(stars, "data", stars)
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+# smallest and largest distance modifier of the stars at each distance, found block by
+# block so a memory-mapped catalog is never read whole
+def mod_ranges(stars, distances):
+    lo = np.full(len(distances), np.inf)
+    hi = np.full(len(distances), -np.inf)
+    for block in star_blocks(stars):
+        lums = img_lums[block["type"]]
+        for i, distance in enumerate(distances):
+            mods = f.inv_sq(lums, block["x"], distance)
+            lo[i], hi[i] = min(lo[i], np.amin(mods)), max(hi[i], np.amax(mods))
+    return list(zip(lo, hi))
+
+# Splat star colors vals centered on pixels (py, pz) onto img, whose top-left pixel is
+# at origin, keeping the brightest value of each channel.
+def splat(img, py, pz, vals, kernel, origin=(0, 0)):
+    flat = img.reshape(-1, 3)
+    for (dy, dz), weight in np.ndenumerate(kernel):
+        if weight <= 0:
+            continue
+        ty = py + (dy - kernel.shape[0] // 2 - origin[0])
+        tz = pz + (dz - kernel.shape[1] // 2 - origin[1])
+        inside = (ty >= 0) & (ty < img.shape[0]) & (tz >= 0) & (tz < img.shape[1])
+        np.maximum.at(flat, ty[inside] * img.shape[1] + tz[inside], (vals[inside] * weight).astype(np.uint8))
+
+# Render stars to images, one per exposure distance, in a single pass over the
+# catalog. Each star's color is scaled by its distance modifier and the kernel.
+# Splatting keeps the brightest value, so stars can be drawn block by block and only
+# one block of the catalog needs to be in memory. The distance modifiers are normalized
+# to ranges (see mod_ranges), by default those of stars.
+def render_stars(stars, img_size, distances, kernel="cross", scale=1, ranges=None):
+    if isinstance(kernel, str):
+        kernel = kernels[kernel]
+    kernel = np.asarray(kernel, dtype=float)
+    if ranges is None:
+        ranges = mod_ranges(stars, distances)
+    imgs = [np.zeros((img_size[1] * scale, img_size[2] * scale, 3), dtype=np.uint8) for _ in distances]
+    for block in star_blocks(stars):
+        # stars sit in the middle of their scaled up voxel
+        py = block["y"].astype(np.int64) * scale + scale // 2
+        pz = block["z"].astype(np.int64) * scale + scale // 2
+        for img, vals in zip(imgs, star_values(block, distances, ranges)):
+            splat(img, py, pz, vals, kernel)
+    return imgs
 
 # write stars to image
-def write_star_image(stars, img_size, name, distance=2):
-    print("Writing {:s}.png to disk (exposure {:d})... ".format(name, distance), end="", flush=True)
-
-    # initialize image
-    img = np.zeros((img_size[1], img_size[2], 3)).astype(np.uint8)
-    i = 0
-    # calculate distance modifiers
-    mods = np.zeros(len(stars)).astype(np.float64)
-    for star in stars:
-        mods[i] = f.inv_sq(star.img_lum(), star.pos()[0], distance)
-        i += 1
-    # normalize to range 0-1
-    mods = (mods - np.amin(mods))/np.ptp(mods)
-
-    # iterate over all stars
-    for star in stars:
-        # modify color by distance and luminosity
-        val = (np.array(star.color()) * mods[stars.index(star)]).astype(np.uint8)
-        # get all surrounding points
-        n = tuple(np.asarray(star.pos()) + np.asarray((0,1,0)))
-        s = tuple(np.asarray(star.pos()) + np.asarray((0,-1,0)))
-        e = tuple(np.asarray(star.pos()) + np.asarray((0,0,1)))
-        w = tuple(np.asarray(star.pos()) + np.asarray((0,0,-1)))
-        # set all surrounding points to that color if they are in the image
-        img[star.pos()[1:3]] = val
-        if n[1] < img_size[1] and np.all(np.less(img[n[1:3]], val)):
-            img[n[1:3]] = val
-        if s[1] > 0 and np.any(np.less(img[s[1:3]], val)):
-            img[s[1:3]] = val
-        if e[2] < img_size[2] and np.any(np.less(img[e[1:3]], val)):
-            img[e[1:3]] = val
-        if w[2] > 0 and np.any(np.less(img[w[1:3]], val)):
-            img[w[1:3]] = val
-    plt.imsave(name+".png", img)
-    print("Done")
-
-def write_HR_diagram(stars, name):
-    print("Writing HR diagram to disk... ", end="", flush=True)
-    # initialize plot
-    plt.rcParams["figure.figsize"] = [9,12]
-    mintemp = np.Inf
-    maxtemp = 0
-    minlum = np.Inf
-    maxlum = 0
-    i = 0
-    # initialize data arrays
-    x = np.zeros((len(stars)+1))
-    y = np.zeros((len(stars)+1))
-    c = np.zeros((len(stars)+1, 3))
-    # iterate over stars
-    for star in stars:
-        # determine approximate absolute temperature
-        x[i] = np.log10(star.temp() * 1000)
-        y[i] = star.lum()
-        c[i] = np.array(star.color()) / 255
-        if x[i] < mintemp:
-            mintemp = x[i]
-        if x[i] > maxtemp:
-            maxtemp = x[i]
-        if y[i] < minlum:
-            minlum = y[i]
-        if y[i] > maxlum:
-            maxlum = y[i]
-        i += 1
-    # add the sun as a dark blue point for reference
-    x[len(stars)] = np.log10(5778)
-    y[len(stars)] = 1
-    c[len(stars)] = np.array((255,255,0)) / 255
-    # add data to plot
-    plt.scatter(x, y, s=1, color=c)
-    # modify figure settings
-    plt.xlabel('Surface Temperature (log(K))')
-    plt.gca().set_xlim(maxtemp, mintemp)
-    plt.ylabel('Luminosity (L_sun)')
-    plt.gca().set_ylim(minlum, maxlum)
-    plt.yscale('log')
-    plt.gca().set_facecolor('#282B32')
-    plt.savefig(name+".png", bbox_inches='tight')
-    print("Done")
+def write_star_image(stars, img_size, name, distance=2, kernel="cross", tile=None, scale=1, mosaic="npy"):
+    write_star_images(stars, img_size, [(name, distance)], kernel, tile, scale, mosaic)
+
+# Write stars to several images with different exposures, given as (name, distance)
+# pairs. If tile is given, the images are scaled up by scale and written tile by tile
+# as mosaics (see TileWriter), drawing only the stars that touch each tile.
+def write_star_images(stars, img_size, exposures, kernel="cross", tile=None, scale=1, mosaic="npy"):
+    if tile is None:
+        with inst.span("render_stars", "Rendering {:d} stars".format(len(stars))) as span:
+            imgs = render_stars(stars, img_size, [d for _, d in exposures], kernel, scale)
+            span.count("stars", len(stars))
+        save_star_images(imgs, exposures)
+        return
+    if isinstance(kernel, str):
+        kernel = kernels[kernel]
+    kernel = np.asarray(kernel, dtype=float)
+    shape = (img_size[1] * scale, img_size[2] * scale, 3)
+    outs = [TileWriter(name, shape, tile, mosaic) for name, _ in exposures]
+    tiles = list(outs[0].tiles())
+    with inst.span("write_star_images", "Writing {:d} star mosaics to disk".format(len(outs)), total=len(tiles)) as span:
+        py = stars["y"].astype(np.int64) * scale + scale // 2
+        pz = stars["z"].astype(np.int64) * scale + scale // 2
+        vals = star_values(stars, [d for _, d in exposures])
+        # bin stars by the tile their center falls in. Only stars in a tile and the reach
+        # tiles around it, enough to cover the kernel's radius, can touch it.
+        reach = -(-(max(kernel.shape) // 2) // tile)
+        cols = -(-shape[1] // tile)
+        key = (py // tile) * cols + (pz // tile)
+        order = np.argsort(key, kind="stable")
+        key = key[order]
+        for i, (y0, y1, z0, z1) in enumerate(tiles):
+            ty, tz = y0 // tile, z0 // tile
+            near = []
+            for row in range(max(ty-reach, 0), ty+reach+1):
+                lo = np.searchsorted(key, row * cols + max(tz-reach, 0), side="left")
+                hi = np.searchsorted(key, row * cols + min(tz+reach, cols-1), side="right")
+                near.append(order[lo:hi])
+            near = np.concatenate(near)
+            for out, v in zip(outs, vals):
+                img = np.zeros((y1-y0, z1-z0, 3), dtype=np.uint8)
+                splat(img, py[near], pz[near], v[near], kernel, (y0, z0))
+                out.write(y0, z0, img)
+            span.count("tiles")
+            span.count("stars drawn", int(near.size))
+            span.progress(i + 1)
+        for out in outs:
+            out.close()
+
+# write rendered star images to disk, one per (name, distance) exposure
+def save_star_images(imgs, exposures):
+    for (name, distance), img in zip(exposures, imgs):
+        with inst.span("write_star_image", "Writing {:s}.png to disk (exposure {:d})".format(name, distance)):
+            plt.imsave(name+".png", img)
+
+# approximate absolute log temperature, luminosity and color of stars, as plotted on an
+# HR diagram
+def hr_values(stars):
+    x = np.log10(stars["temp"].astype(np.float64) * 1000)
+    y = stars["lum"].astype(np.float64)
+    return x, y, f.palette[stars["color"]] / 255
+
+# smallest and largest log temperature and luminosity of the stars on an HR diagram,
+# found block by block
+def hr_ranges(stars):
+    mintemp, maxtemp, minlum, maxlum = np.inf, -np.inf, np.inf, -np.inf
+    for block in star_blocks(stars):
+        x, y, _ = hr_values(block)
+        mintemp, maxtemp = min(mintemp, np.amin(x)), max(maxtemp, np.amax(x))
+        minlum, maxlum = min(minlum, np.amin(y)), max(maxlum, np.amax(y))
+    return mintemp, maxtemp, minlum, maxlum
+
+# above this many stars, "auto" mode draws HR diagrams in "density" mode
+hr_density_stars = 10**6
+
+# Write a Hertzsprung-Russell diagram. In "scatter" mode every star is plotted as a
+# point. In "density" mode stars are binned on a bins x bins grid of log temperature and
+# log luminosity, and each bin is drawn in the mean color of its stars, brighter the
+# more stars it holds. Stars are binned block by block, so the plot costs the same
+# however many stars there are and a memory-mapped catalog is never read whole. "auto"
+# mode is "density" above hr_density_stars stars and "scatter" otherwise.
+def write_HR_diagram(stars, name, mode="scatter", bins=512):
+    if mode == "auto":
+        mode = "density" if len(stars) > hr_density_stars else "scatter"
+    with inst.span("write_HR_diagram", "Writing HR diagram to disk") as span:
+        # initialize plot. A standalone figure rather than pyplot's global one, so diagrams
+        # can be drawn on several threads at once.
+        fig = Figure(figsize=[9,12])
+        ax = fig.add_subplot()
+        mintemp, maxtemp, minlum, maxlum = hr_ranges(stars)
+        # the sun, for reference
+        sun_x, sun_y, sun_c = np.log10(5778), 1, np.array((255,255,0)) / 255
+        if mode == "density":
+            extent = (mintemp, maxtemp, np.log10(minlum), np.log10(maxlum))
+            edges = (np.linspace(extent[0], extent[1], bins+1), np.linspace(extent[2], extent[3], bins+1))
+            # star counts and summed colors of each bin
+            counts = np.zeros((bins, bins))
+            sums = np.zeros((3, bins, bins))
+            for block in star_blocks(stars):
+                x, y, c = hr_values(block)
+                y = np.log10(y)
+                counts += np.histogram2d(x, y, edges)[0]
+                for i in range(3):
+                    sums[i] += np.histogram2d(x, y, edges, weights=c[:, i])[0]
+            img = np.zeros((bins, bins, 4))
+            filled = counts > 0
+            for i in range(3):
+                img[..., i][filled] = sums[i][filled] / counts[filled]
+            img[..., 3] = np.log1p(counts) / np.log1p(np.amax(counts))
+            # histogram2d indexes bins by (x, y), images by (row, column)
+            ax.imshow(img.transpose(1, 0, 2), origin="lower", extent=extent, aspect="auto", interpolation="nearest")
+            ax.scatter([sun_x], [0], s=4, color=[sun_c])
+            ax.set_ylabel('Luminosity (log(L_sun))')
+            ax.set_ylim(extent[2], extent[3])
+        else:
+            # add data to plot
+            x, y, c = hr_values(stars)
+            ax.scatter(np.append(x, sun_x), np.append(y, sun_y), s=1, color=np.vstack((c, sun_c)))
+            ax.set_ylabel('Luminosity (L_sun)')
+            ax.set_ylim(minlum, maxlum)
+            ax.set_yscale('log')
+        # modify figure settings
+        ax.set_xlabel('Surface Temperature (log(K))')
+        ax.set_xlim(maxtemp, mintemp)
+        ax.set_facecolor('#282B32')
+        fig.savefig(name+".png", bbox_inches='tight')
+        span.count("stars", len(stars))